@@ -0,0 +1,294 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A content-addressed cache of builder outputs."""
+
+import atexit
+import hashlib
+import http.client
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+import urllib.parse
+import zlib
+
+import deletion_service
+import paths
+import utils
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+"""Size of the chunks entries are read, compressed and sent in."""
+CHUNK_SIZE: int = 1 << 20
+
+"""Header with the sha256 of the uncompressed entry."""
+SHA256_HEADER: str = 'X-Content-SHA256'
+
+"""Errors of remote backends, e.g. unreachable servers or truncated responses."""
+REMOTE_ERRORS = (OSError, RuntimeError, http.client.HTTPException, zlib.error)
+
+
+def file_sha256(path: Path) -> str:
+    """Returns the sha256 of a file."""
+    sha = hashlib.sha256()
+    with path.open('rb') as infile:
+        while chunk := infile.read(CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+_compiler_identities: Dict[Tuple[Path, int, int], str] = {}
+_compiler_identities_lock = threading.Lock()
+
+
+def compiler_identity(compiler: Path) -> str:
+    """Returns a hash of the compiler binary, so rebuilt compilers get new keys."""
+    try:
+        real_path = compiler.resolve(strict=True)
+    except OSError:
+        return str(compiler)
+    stat = real_path.stat()
+    key = (real_path, stat.st_mtime_ns, stat.st_size)
+    with _compiler_identities_lock:
+        if key not in _compiler_identities:
+            _compiler_identities[key] = file_sha256(real_path)
+        return _compiler_identities[key]
+
+
+class RemoteBackend:
+    """A remote store of cache entries, shared by several build machines."""
+
+    def get(self, key: str, dest: Path) -> bool:
+        """Downloads the entry for key to dest. Returns False if there is none."""
+        raise NotImplementedError()
+
+    def put(self, key: str, src: Path) -> None:
+        """Uploads src as the entry for key."""
+        raise NotImplementedError()
+
+
+class HttpBackend(RemoteBackend):
+    """Stores entries at <url>/<key> with HTTP GET and PUT.
+
+    Entries are sent zlib compressed with chunked transfer encoding, along with
+    the sha256 of the uncompressed entry, which downloads are verified against.
+    artifact_cache_server.py implements the server side.
+    """
+
+    def __init__(self, url: str, timeout: float = 60) -> None:
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported remote cache url: {url}')
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+    def _path(self, key: str) -> str:
+        return f'{self.url.path.rstrip("/")}/{key}'
+
+    def get(self, key: str, dest: Path) -> bool:
+        conn = self._connection()
+        try:
+            conn.request('GET', self._path(key))
+            response = conn.getresponse()
+            if response.status == http.client.NOT_FOUND:
+                return False
+            if response.status != http.client.OK:
+                raise RuntimeError(f'GET {key} failed: {response.status} {response.reason}')
+            expected_sha = response.getheader(SHA256_HEADER)
+            decompressor = zlib.decompressobj()
+            sha = hashlib.sha256()
+            try:
+                with dest.open('wb') as outfile:
+                    while chunk := response.read(CHUNK_SIZE):
+                        data = decompressor.decompress(chunk)
+                        sha.update(data)
+                        outfile.write(data)
+                    data = decompressor.flush()
+                    sha.update(data)
+                    outfile.write(data)
+                if not decompressor.eof:
+                    raise RuntimeError(f'GET {key}: truncated response')
+            except:
+                # Don't leave a partial entry behind.
+                dest.unlink(missing_ok=True)
+                raise
+        finally:
+            conn.close()
+        if sha.hexdigest() != expected_sha:
+            dest.unlink()
+            raise RuntimeError(f'GET {key}: sha256 mismatch, expected {expected_sha}, '
+                               f'got {sha.hexdigest()}')
+        return True
+
+    @staticmethod
+    def _compressed_chunks(src: Path) -> Iterator[bytes]:
+        compressor = zlib.compressobj()
+        with src.open('rb') as infile:
+            while chunk := infile.read(CHUNK_SIZE):
+                if data := compressor.compress(chunk):
+                    yield data
+        yield compressor.flush()
+
+    def put(self, key: str, src: Path) -> None:
+        conn = self._connection()
+        try:
+            conn.request('PUT', self._path(key), body=self._compressed_chunks(src),
+                         headers={SHA256_HEADER: file_sha256(src)}, encode_chunked=True)
+            response = conn.getresponse()
+            response.read()
+            if response.status not in (http.client.OK, http.client.CREATED):
+                raise RuntimeError(f'PUT {key} failed: {response.status} {response.reason}')
+        finally:
+            conn.close()
+
+
+class ArtifactCache:
+    """Stores builder outputs as tar files named by the hash of their inputs.
+
+    Outputs are stored relative to OUT_DIR, and entries are evicted in least
+    recently used order once the cache grows over max_size bytes. Entries
+    missing locally are fetched from the remote backend, if any, and new
+    entries are uploaded to it.
+    """
+
+    def __init__(self, root: Path, max_size: int,
+                 remote: Optional[RemoteBackend] = None) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.remote = remote
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Local hits, remote hits and misses of each builder.
+        self._stats: Dict[str, List[int]] = {}
+
+    def _entry(self, key: str) -> Path:
+        return self.root / f'{key}.tar'
+
+    @staticmethod
+    def _relative_paths(artifacts: List[Path]) -> List[str]:
+        return [str(artifact.relative_to(paths.OUT_DIR)) for artifact in artifacts]
+
+    def _tmp_entry(self, entry: Path) -> Path:
+        return entry.parent / f'{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def _count(self, name: str, index: int) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(name, [0, 0, 0])
+            stats[index] += 1
+
+    def _fetch_remote(self, key: str, entry: Path) -> bool:
+        if self.remote is None:
+            return False
+        tmp_entry = self._tmp_entry(entry)
+        try:
+            if not self.remote.get(key, tmp_entry):
+                return False
+        except REMOTE_ERRORS as e:
+            # The remote cache is an optimization, so build instead.
+            logger().warning('Failed to download %s from remote cache: %s', key, e)
+            tmp_entry.unlink(missing_ok=True)
+            return False
+        tmp_entry.replace(entry)
+        return True
+
+    def fetch(self, name: str, key: str, artifacts: List[Path]) -> bool:
+        """Restores artifacts from the cache. Returns False on a cache miss."""
+        entry = self._entry(key)
+        if entry.exists():
+            logger().info('Artifact cache hit for %s: %s', name, key)
+            self._count(name, 0)
+        elif self._fetch_remote(key, entry):
+            logger().info('Remote artifact cache hit for %s: %s', name, key)
+            self._count(name, 1)
+        else:
+            logger().info('Artifact cache miss for %s: %s', name, key)
+            self._count(name, 2)
+            return False
+        # Mark the entry as recently used, before anything can evict it.
+        os.utime(entry)
+        for artifact in artifacts:
+            deletion_service.delete(artifact)
+        utils.check_call(['tar', '-xf', str(entry), '-C', str(paths.OUT_DIR)])
+        self._evict()
+        return True
+
+    def store(self, name: str, key: str, artifacts: List[Path]) -> None:
+        """Stores artifacts in the cache."""
+        existing = [artifact for artifact in artifacts if artifact.exists()]
+        if not existing:
+            return
+        entry = self._entry(key)
+        tmp_entry = self._tmp_entry(entry)
+        utils.check_call(['tar', '-cf', str(tmp_entry), '-C', str(paths.OUT_DIR)] +
+                         self._relative_paths(existing))
+        tmp_entry.replace(entry)
+        logger().info('Stored %s in artifact cache: %s', name, key)
+        if self.remote is not None:
+            try:
+                self.remote.put(key, entry)
+            except REMOTE_ERRORS as e:
+                logger().warning('Failed to upload %s to remote cache: %s', key, e)
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = sorted(self.root.glob('*.tar'), key=lambda entry: entry.stat().st_mtime)
+            size = sum(entry.stat().st_size for entry in entries)
+            while size > self.max_size and entries:
+                entry = entries.pop(0)
+                size -= entry.stat().st_size
+                logger().info('Evicting %s from artifact cache', entry.name)
+                entry.unlink()
+
+    def report(self) -> str:
+        """Returns '<hits> hits (<remote hits> remote), <misses> misses: <builder>' lines."""
+        with self._lock:
+            return '\n'.join(f'{hits + remote_hits} hits ({remote_hits} remote), '
+                             f'{misses} misses: {name}'
+                             for name, (hits, remote_hits, misses) in sorted(self._stats.items()))
+
+    def report_to_file(self, outfile: Path) -> None:
+        """Logs the report and writes it to outfile."""
+        report = self.report()
+        logger().info('Artifact cache:\n%s', report)
+        with open(outfile, 'w') as out:
+            out.write(report)
+
+
+_cache: Optional[ArtifactCache] = None
+
+
+def start(root: Path, max_size: int, report_file: Path,
+          remote: Optional[RemoteBackend] = None) -> ArtifactCache:
+    """Enables the artifact cache, and writes its report to report_file at exit."""
+    global _cache  # pylint: disable=global-statement
+    _cache = ArtifactCache(root, max_size, remote)
+    atexit.register(_cache.report_to_file, report_file)
+    return _cache
+
+
+def get() -> Optional[ArtifactCache]:
+    """Returns the artifact cache, or None if it is disabled."""
+    return _cache
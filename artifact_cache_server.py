@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A reference server for the remote artifact cache (do_build.py --remote-cache).
+
+Entries are stored zlib compressed, as uploaded, next to a file with the
+sha256 of the uncompressed entry. Uploads are verified against their sha256
+before they are stored.
+"""
+
+import argparse
+import hashlib
+import http.server
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Iterator
+import zlib
+
+import artifact_cache
+
+
+class ArtifactCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Handles GET and PUT of /<key>."""
+    protocol_version = 'HTTP/1.1'
+    root: Path
+
+    def _entry(self) -> Path:
+        key = self.path.rsplit('/', 1)[-1]
+        if not re.fullmatch(r'[0-9a-f]+', key):
+            raise ValueError(f'Invalid key {key}')
+        return self.root / key
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        try:
+            entry = self._entry()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        sha_file = entry.with_suffix('.sha256')
+        if not sha_file.exists():
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header(artifact_cache.SHA256_HEADER, sha_file.read_text())
+        self.send_header('Content-Length', str(entry.stat().st_size))
+        self.end_headers()
+        with entry.open('rb') as infile:
+            while chunk := infile.read(artifact_cache.CHUNK_SIZE):
+                self.wfile.write(chunk)
+
+    def _body(self) -> Iterator[bytes]:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # Skip trailers up to the final empty line.
+                    while self.rfile.readline().strip():
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, artifact_cache.CHUNK_SIZE))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def do_PUT(self) -> None:  # pylint: disable=invalid-name
+        try:
+            entry = self._entry()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        expected_sha = self.headers.get(artifact_cache.SHA256_HEADER)
+        tmp_entry = entry.parent / f'{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+        decompressor = zlib.decompressobj()
+        sha = hashlib.sha256()
+        try:
+            with tmp_entry.open('wb') as outfile:
+                for chunk in self._body():
+                    outfile.write(chunk)
+                    sha.update(decompressor.decompress(chunk))
+                sha.update(decompressor.flush())
+        except zlib.error as e:
+            tmp_entry.unlink()
+            self.send_error(400, f'Invalid compressed data: {e}')
+            return
+        if sha.hexdigest() != expected_sha:
+            tmp_entry.unlink()
+            self.send_error(400, 'sha256 mismatch')
+            return
+        tmp_entry.replace(entry)
+        entry.with_suffix('.sha256').write_text(expected_sha)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--bind', default='localhost', help='Address to listen on.')
+    parser.add_argument('--dir', type=Path, required=True, help='Directory to store entries in.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.dir.mkdir(parents=True, exist_ok=True)
+    ArtifactCacheHandler.root = args.dir.resolve()
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), ArtifactCacheHandler)
+    print(f'Serving {ArtifactCacheHandler.root} on {args.bind}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,8 @@
 #
 """Builders for various build tools and build systems."""
 
+from concurrent import futures
+import copy
 import functools
 from pathlib import Path
 import logging
@@ -23,15 +25,27 @@ import os
 import re
 import shutil
 import subprocess
-from typing import cast, Dict, List, Optional, Set, Sequence
+from typing import Any, cast, Dict, List, Optional, Set, Sequence, Tuple
 
 import android_version
+import artifact_cache
+import build_journal
+import build_plan
 from builder_registry import BuilderRegistry
+import cmake_check_cache
 import configs
 import constants
+import deletion_service
+import disk_usage
 import hosts
+import jobserver
+import library_id
+import memoize
 import paths
+import remote_worker
+import source_manager
 import timer
+import tmpfs
 import toolchains
 import utils
 import win_sdk
@@ -63,19 +77,15 @@ class LibInfo:
         if not lib.exists():
             raise RuntimeError('Lookup of version before library is built')
 
-        objdump_output = utils.check_output([toolchains.get_prebuilt_toolchain().objdump,
-                                             '-p', lib])
-
+        lib_id = library_id.read(lib)
         if target_os.is_linux:
-            regex = f'SONAME\\s*{self.name}.so.([0-9.]*)'
+            regex = f'{re.escape(self.name)}\\.so\\.([0-9.]*)'
         else:
-            regex = f'name .*/{self.name}.([0-9.]*).dylib \(offset.*'
-        version = re.findall(regex, objdump_output)
+            regex = f'(?:.*/)?{re.escape(self.name)}\\.([0-9.]*)\\.dylib'
+        version = re.fullmatch(regex, lib_id or '')
         if not version:
-            print('objdump output is')
-            print(objdump_output)
-            raise RuntimeError(f'Cannot find regex pattern {regex}')
-        return version[0]
+            raise RuntimeError(f'{lib} has id {lib_id}, which does not match {regex}')
+        return version.group(1)
 
     @property
     def install_dir(self) -> Path:
@@ -145,9 +155,13 @@ class LibInfo:
                                   f'@rpath/{other_lib.name}', str(lib)])
 
 
-class Builder:  # pylint: disable=too-few-public-methods
+class Builder(memoize.Memoized):  # pylint: disable=too-few-public-methods
     """Base builder type."""
     name: str = ""
+
+    """Properties memoized per config. Setting an attribute of the builder forgets them."""
+    memoized_properties = frozenset({'cflags', 'cxxflags', 'ldflags', 'env', 'cmake_defines'})
+    _memo_key_attributes = frozenset({'_config'})
     config_list: List[configs.Config]
 
     """Use prebuilt toolchain by default. This value will be updated if a new toolchain is built."""
@@ -156,6 +170,30 @@ class Builder:  # pylint: disable=too-few-public-methods
     """The toolchain to install artifacts from this LLVMRuntimeBuilder."""
     output_toolchain: toolchains.Toolchain
 
+    """Names of builders whose outputs are needed by this builder."""
+    depends_on: List[str] = []
+
+    """Whether configs are independent of each other and may be built concurrently."""
+    concurrent_configs: bool = False
+
+    """Maximum number of configs to build at once when concurrent_configs is set."""
+    config_jobs: int = 1
+
+    """Whether outputs only depend on the inputs in the fingerprint, so they can be cached."""
+    cacheable: bool = False
+
+    """Whether the last config was fetched from the artifact cache instead of built."""
+    fetched_from_cache: bool = False
+
+    """Whether the build dir of a config is no longer read once the config is installed."""
+    intermediate_output_dir: bool = False
+
+    """Whether configs may be built by workers (see remote_worker.py)."""
+    remote_buildable: bool = False
+
+    """Tells apart the steps of builders of the same name, e.g. host libraries of the musl stage2."""
+    step_suffix: str = ''
+
     def __init__(self,
                  config_list: Optional[Sequence[configs.Config]] = None,
                  toolchain: Optional[toolchains.Toolchain] = None) -> None:
@@ -168,17 +206,148 @@ class Builder:  # pylint: disable=too-few-public-methods
     @BuilderRegistry.register_and_build
     def build(self) -> None:
         """Builds all configs."""
-        for config in self.config_list:
-            self._config = config
-
+        if plan := build_plan.get():
+            plan.record_builder(self)
+            return
+        if self.concurrent_configs and self.config_jobs > 1 and len(self.config_list) > 1:
+            self._build_configs_concurrently()
+            self._config = self.config_list[-1]
+        else:
+            for config in self.config_list:
+                self._config = config
+                self._build_current_config()
+        def fingerprint() -> str:
+            return utils.fingerprint([self.config_view(config).fingerprint
+                                      for config in self.config_list])
+        build_journal.get().run(f'{self.name}{self.step_suffix}_install', fingerprint,
+                                self.install)
+
+    def _build_current_config(self) -> None:
+        def build_config() -> None:
             logger().info('Building %s for %s', self.name, self._config)
-            with timer.Timer(f'{self.name}_{self._config}'):
-                self._build_config()
-        self.install()
+            self._build_or_fetch_config()
+        build_journal.get().run(self.step_name, lambda: self.fingerprint, build_config)
+        output_dir = getattr(self, 'output_dir', None)
+        if output_dir and (usage := disk_usage.get()):
+            if self.intermediate_output_dir:
+                usage.release(self.step_name, output_dir)
+            else:
+                usage.record(self.step_name, output_dir)
+
+    @property
+    def step_name(self) -> str:
+        """Names the current config in build times, the build journal and plans."""
+        name = f'{self.name}{self.step_suffix}_{self._config}'
+        # Some configs only differ in their output dir, e.g. Linux configs of
+        # different arches.
+        if [str(config) for config in self.config_list].count(str(self._config)) > 1:
+            name += self._config.output_suffix
+        return name
+
+    def _build_or_fetch_config(self) -> None:
+        cache = artifact_cache.get()
+        if not self.cacheable or cache is None:
+            self._build_config_on_worker_or_locally()
+            return
+        key = self.cache_key
+        self.fetched_from_cache = cache.fetch(self.name, key, self.cache_artifacts)
+        if not self.fetched_from_cache:
+            self._build_config_on_worker_or_locally()
+            cache.store(self.name, key, self.cache_artifacts)
+
+    def _build_config_on_worker_or_locally(self) -> None:
+        pool = remote_worker.get()
+        if not self.remote_buildable or pool is None or not pool.build(self):
+            self._build_config()
+
+    @property
+    def remote_inputs(self) -> List[Path]:
+        """Dirs in OUT_DIR that the current config reads, synced to workers."""
+        return []
+
+    @property
+    def remote_outputs(self) -> List[Path]:
+        """Dirs in OUT_DIR that the current config installs to, copied back from workers."""
+        return [self.install_dir]
+
+    @property
+    def cache_artifacts(self) -> List[Path]:
+        """Outputs of the current config, stored in the artifact cache."""
+        return [self.install_dir]
+
+    @property
+    def cache_key(self) -> str:
+        """The artifact cache key of the current config."""
+        return utils.fingerprint([self.fingerprint, artifact_cache.compiler_identity(self._cc)])
+
+    def config_view(self, config: configs.Config) -> 'Builder':
+        """Returns a copy of this builder bound to config.
+
+        Building the copy doesn't touch self._config, so views of the same
+        builder can build different configs at the same time.
+        """
+        view = copy.copy(self)
+        view._config = config
+        return view
+
+    def _memo_key(self) -> Tuple[Any, ...]:
+        # Class attributes, e.g. the default toolchain, and the tmpfs placement
+        # of output_dir change without setting attributes of the builder.
+        return (self._config, self.toolchain, getattr(self, 'output_toolchain', None),
+                getattr(self, 'output_dir', None))
+
+    def _build_configs_concurrently(self) -> None:
+        # Each config waits for the steps before the builder, not for the
+        # configs that happen to finish before it.
+        before = timer.Timer.frontier()
+        ends: List[str] = []
+
+        def build_config(view: Builder) -> None:
+            timer.Timer.set_frontier(before)
+            view._build_current_config()
+            ends.extend(timer.Timer.frontier())
+
+        with futures.ThreadPoolExecutor(max_workers=self.config_jobs) as executor:
+            results = [executor.submit(build_config, self.config_view(config))
+                       for config in self.config_list]
+            _, not_done = futures.wait(results, return_when=futures.FIRST_EXCEPTION)
+            # Don't start more configs after a failure.
+            for result in not_done:
+                result.cancel()
+        timer.Timer.set_frontier(ends)
+        for result in results:
+            if not result.cancelled():
+                result.result()
 
     def _build_config(self) -> None:
         raise NotImplementedError()
 
+    @property
+    def fingerprint(self) -> str:
+        """A fingerprint of the inputs of the current config.
+
+        The build journal uses it to tell whether a config must be built again.
+        """
+        return utils.fingerprint(self._fingerprint_inputs)
+
+    @property
+    def _fingerprint_inputs(self) -> Dict[str, Any]:
+        output_toolchain = getattr(self, 'output_toolchain', None)
+        src_dir = getattr(self, 'src_dir', None)
+        return {
+            'builder': type(self).__name__,
+            'config': str(self._config),
+            'toolchain': str(self.toolchain.path),
+            'output_toolchain': str(output_toolchain.path) if output_toolchain else None,
+            'cflags': [memoize.fingerprint(self._config, 'cflags'),
+                       memoize.fingerprint(self, 'cflags')],
+            'cxxflags': [memoize.fingerprint(self._config, 'cxxflags'),
+                         memoize.fingerprint(self, 'cxxflags')],
+            'ldflags': [memoize.fingerprint(self._config, 'ldflags'),
+                        memoize.fingerprint(self, 'ldflags')],
+            'sources': source_manager.source_fingerprint(src_dir) if src_dir else None,
+        }
+
     def _is_64bit(self) -> bool:
         return self._config.target_arch in (hosts.Arch.AARCH64, hosts.Arch.X86_64)
 
@@ -222,6 +391,9 @@ class Builder:  # pylint: disable=too-few-public-methods
             utils.ORIG_ENV.get('PATH')
         ]
         env['PATH'] = os.pathsep.join(p for p in path_env if p)
+        # Let make and ninja take their job slots from the shared jobserver.
+        if server := jobserver.get():
+            env['MAKEFLAGS'] = server.makeflags
         return env
 
     @property
@@ -253,6 +425,7 @@ class AutoconfBuilder(Builder):
         return output_dir.parent / (output_dir.name + '-install')
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _get_mac_sdk_path() -> Path:
         out = subprocess.check_output(['xcrun', '--show-sdk-path'], text=True)
         return Path(out.strip())
@@ -280,6 +453,12 @@ class AutoconfBuilder(Builder):
         """Parameters to configure."""
         return []
 
+    @property
+    def _fingerprint_inputs(self) -> Dict[str, Any]:
+        inputs = super()._fingerprint_inputs
+        inputs['config_flags'] = self.config_flags
+        return inputs
+
     def _touch_src_dir(self, files) -> None:
         for file in files:
             file_path = self.src_dir / file
@@ -287,16 +466,56 @@ class AutoconfBuilder(Builder):
                 file_path.touch(exist_ok=True)
 
     def _touch_autoconfig_files(self) -> None:
-        """Touches configure files to prevent autoreconf."""
+        """Touches configure files to prevent autoreconf.
+
+        The *.in files are listed in a stamp file, along with a fingerprint of
+        the sources, and the stamp is touched last. Later builds skip the
+        recursive glob and the touches, unless the sources changed, e.g.
+        after a source update, or a listed file or configure.ac is newer.
+        """
         files_to_touch = ["aclocal.m4", "configure", "Makefile.am"]
+        sources = source_manager.source_fingerprint(self.src_dir)
+        stamp = paths.OUT_DIR / 'autoconf-touched' / utils.fingerprint(str(self.src_dir))
+        if stamp.exists():
+            recorded_sources, *in_files = stamp.read_text().splitlines()
+            stamp_mtime = stamp.stat().st_mtime_ns
+            checked = files_to_touch + ['configure.ac'] + in_files
+            if recorded_sources == sources and all(
+                    not file_path.exists() or file_path.stat().st_mtime_ns <= stamp_mtime
+                    for file_path in (self.src_dir / file for file in checked)):
+                return
+        in_files = [str(path.relative_to(self.src_dir)) for path in self.src_dir.glob('**/*.in')]
         self._touch_src_dir(files_to_touch)
-        self._touch_src_dir(self.src_dir.glob('**/*.in'))
+        self._touch_src_dir(in_files)
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.write_text(''.join(f'{line}\n' for line in [sources] + in_files))
+
+    def _autoconf_cache_file(self, env: Dict[str, str]) -> Path:
+        """Returns the configure cache of the current config and its compilers and flags.
+
+        Caches of the current config for other compilers or flags are deleted.
+        """
+        key = utils.fingerprint({
+            'cc': artifact_cache.compiler_identity(self._cc),
+            'cxx': artifact_cache.compiler_identity(self._cxx),
+            'cflags': (self.output_dir / 'cflags').read_text(),
+            'cxxflags': (self.output_dir / 'cxxflags').read_text(),
+            'config_flags': self.config_flags,
+            'env': {key: env.get(key) for key in ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS')},
+        })
+        cache_dir = paths.OUT_DIR / 'autoconf-cache'
+        prefix = f'{self.name}{self._config.output_suffix}.'
+        for stale in cache_dir.glob(f'{prefix}*.cache'):
+            if stale.name != f'{prefix}{key}.cache':
+                stale.unlink(missing_ok=True)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return cache_dir / f'{prefix}{key}.cache'
 
     def _build_config(self) -> None:
         logger().info('Building %s for %s', self.name, self._config)
 
-        if self.remove_install_dir and self.install_dir.exists():
-            shutil.rmtree(self.install_dir)
+        if self.remove_install_dir:
+            deletion_service.delete(self.install_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self._touch_autoconfig_files()
 
@@ -325,15 +544,32 @@ class AutoconfBuilder(Builder):
             env['CFLAGS'] = universal_cflags
             env['CXXFLAGS'] = universal_cflags
 
-        config_cmd = [str(self.src_dir / 'configure'), f'--prefix={self.install_dir}']
+        # Reuse the results of configure's probes from earlier builds.
+        cache_file = self._autoconf_cache_file(env)
+        config_cmd = [str(self.src_dir / 'configure'), f'--prefix={self.install_dir}',
+                      f'--cache-file={cache_file}']
         config_cmd.extend(self.config_flags)
         utils.create_script(self.output_dir / 'config_invocation.sh', config_cmd, env)
-        utils.check_call(config_cmd, cwd=self.output_dir, env=env)
-
-        make_cmd = [str(paths.MAKE_BIN_PATH), f'-j{multiprocessing.cpu_count()}']
-        utils.check_call(make_cmd, cwd=self.output_dir, env=self.env)
-
-        self.install_config()
+        with timer.Timer(f'{self.step_name}_configure', parent=self.step_name):
+            try:
+                utils.check_call(config_cmd, cwd=self.output_dir, env=env)
+            except subprocess.CalledProcessError:
+                if not cache_file.exists():
+                    raise
+                # configure refuses caches it considers inconsistent.
+                logger().warning('Configuring %s failed, retrying without %s',
+                                 self.step_name, cache_file)
+                cache_file.unlink()
+                utils.check_call(config_cmd, cwd=self.output_dir, env=env)
+
+        make_cmd = [str(paths.MAKE_BIN_PATH)]
+        if not jobserver.get():
+            make_cmd.append(f'-j{multiprocessing.cpu_count()}')
+        with timer.Timer(f'{self.step_name}_make', parent=self.step_name):
+            utils.check_call(make_cmd, cwd=self.output_dir, env=self.env)
+
+        with timer.Timer(f'{self.step_name}_install', parent=self.step_name):
+            self.install_config()
 
     def install_config(self) -> None:
         """Installs built artifacts for current config."""
@@ -351,6 +587,9 @@ class CMakeBuilder(Builder):
     remove_install_dir: bool = False
     ninja_targets: List[str] = []
 
+    """Whether configure check results are shared with configures of the same compiler and flags."""
+    share_cmake_checks: bool = False
+
     @property
     def output_dir(self) -> Path:
         """The path for intermediate results."""
@@ -429,6 +668,21 @@ class CMakeBuilder(Builder):
         defines.update(self._config.cmake_defines)
         return defines
 
+    """CMake defines that change how the build runs, but not what it produces."""
+    scheduling_defines: Set[str] = {
+        'CMAKE_C_LINKER_LAUNCHER',
+        'CMAKE_CXX_LINKER_LAUNCHER',
+        'LLVM_PARALLEL_COMPILE_JOBS',
+        'LLVM_PARALLEL_LINK_JOBS',
+    }
+
+    @property
+    def _fingerprint_inputs(self) -> Dict[str, Any]:
+        inputs = super()._fingerprint_inputs
+        inputs['cmake_defines'] = {key: value for key, value in self.cmake_defines.items()
+                                   if key not in self.scheduling_defines}
+        return inputs
+
     def _get_cmake_system_name(self) -> str:
         return self._config.target_os.value.capitalize()
 
@@ -443,8 +697,73 @@ class CMakeBuilder(Builder):
             if 'CMakeFiles' in dirs:
                 shutil.rmtree(os.path.join(dirpath, 'CMakeFiles'))
 
+    @staticmethod
+    def _cmake_regeneration_inputs(build_ninja: Path) -> List[str]:
+        """Returns the inputs of the build.ninja edge that reruns cmake."""
+        # Join continued lines, then split on unescaped whitespace.
+        text = re.sub(r'\$\n\s*', ' ', build_ninja.read_text())
+        for line in text.splitlines():
+            if not line.startswith('build build.ninja') or 'RERUN_CMAKE' not in line:
+                continue
+            tokens = re.split(r'(?<!\$) +', line.split('RERUN_CMAKE', 1)[1])
+            return [re.sub(r'\$(.)', r'\1', token) for token in tokens
+                    if token and token not in ('|', '||')]
+        return []
+
+    """CMake defines that configure checks depend on, besides the compilers."""
+    check_defines: Set[str] = {
+        'ANDROID',
+        'CMAKE_ASM_FLAGS',
+        'CMAKE_C_FLAGS',
+        'CMAKE_CXX_FLAGS',
+        'CMAKE_EXE_LINKER_FLAGS',
+        'CMAKE_MODULE_LINKER_FLAGS',
+        'CMAKE_SHARED_LINKER_FLAGS',
+        'CMAKE_OSX_ARCHITECTURES',
+        'CMAKE_OSX_DEPLOYMENT_TARGET',
+        'CMAKE_SYSROOT',
+        'CMAKE_SYSTEM_NAME',
+        'CMAKE_SYSTEM_PROCESSOR',
+        'CMAKE_SYSTEM_VERSION',
+    }
+
+    @property
+    def _cmake_check_key(self) -> str:
+        """Keys the configure check results of the current config."""
+        defines = self.cmake_defines
+        return utils.fingerprint({
+            # The same check names mean different things in different
+            # projects, e.g. with other CMAKE_REQUIRED_FLAGS.
+            'builder': self.name,
+            'src_dir': str(self.src_dir),
+            'cc': artifact_cache.compiler_identity(self._cc),
+            'cxx': artifact_cache.compiler_identity(self._cxx),
+            'triple': self._config.llvm_triple,
+            'defines': {key: defines.get(key) for key in sorted(self.check_defines)},
+        })
+
+    def _cmake_hash(self, cmake_cmd: List[str], env: Dict[str, str]) -> str:
+        """Hashes the inputs of the configure step."""
+        # Scheduling defines change with the host load, e.g. link jobs are
+        # based on the available memory, and don't justify a reconfigure.
+        scheduling = tuple(f'-D{key}=' for key in self.scheduling_defines)
+        inputs = []
+        for path in self._cmake_regeneration_inputs(self.output_dir / 'build.ninja'):
+            try:
+                stat = os.stat(self.output_dir / path)
+                inputs.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                inputs.append((path, None, None))
+        return utils.fingerprint({
+            'cmd': [arg for arg in cmake_cmd if not arg.startswith(scheduling)],
+            'env': {key: value for key, value in env.items() if key != 'MAKEFLAGS'},
+            'inputs': inputs,
+        })
+
     def _ninja(self, args: list[str], add_env: Optional[Dict[str, str]] = None) -> None:
         """ Build ninja targets.
+            Parallelism comes from the jobserver in self.env if there is one,
+            so no -j is passed here.
             Args:
                 args: ninja targets to build
                 add_env: additional environment variables
@@ -457,12 +776,41 @@ class CMakeBuilder(Builder):
             ninja_env = self.env
         utils.check_call(ninja_cmd, cwd=self.output_dir, env=ninja_env)
 
+    def _configure(self, cmake_cmd: List[str], env: Dict[str, str]) -> None:
+        """Runs cmake, seeded with the shared check results if share_cmake_checks is set."""
+        if not self.share_cmake_checks:
+            utils.create_script(self.output_dir / 'cmake_invocation.sh', cmake_cmd, env)
+            utils.check_call(cmake_cmd, cwd=self.output_dir, env=env)
+            return
+        check_key = self._cmake_check_key
+        check_cache = cmake_check_cache.load(check_key)
+        if check_cache is None:
+            # Run all checks, rather than reuse the results in the build dir,
+            # so they validate the shared ones.
+            self._rm_cmake_cache(self.output_dir)
+            utils.create_script(self.output_dir / 'cmake_invocation.sh', cmake_cmd, env)
+            utils.check_call(cmake_cmd, cwd=self.output_dir, env=env)
+            cmake_check_cache.collect(check_key, self.output_dir, seeded=False)
+            return
+        # The initial cache only saves work, so it's left out of the configure hash.
+        seeded_cmd = cmake_cmd[:1] + ['-C', str(check_cache)] + cmake_cmd[1:]
+        utils.create_script(self.output_dir / 'cmake_invocation.sh', seeded_cmd, env)
+        try:
+            utils.check_call(seeded_cmd, cwd=self.output_dir, env=env)
+        except subprocess.CalledProcessError:
+            logger().warning('Configuring %s with shared check results failed, '
+                             'running all checks', self.step_name)
+            cmake_check_cache.discard(check_key)
+            self._configure(cmake_cmd, env)
+            return
+        cmake_check_cache.collect(check_key, self.output_dir, seeded=True)
+
     def _build_config(self) -> None:
         if self.remove_cmake_cache:
             self._rm_cmake_cache(self.output_dir)
 
-        if self.remove_install_dir and self.install_dir.exists():
-            shutil.rmtree(self.install_dir)
+        if self.remove_install_dir:
+            deletion_service.delete(self.install_dir)
 
         cmake_cmd: List[str] = [str(paths.CMAKE_BIN_PATH), '-G', 'Ninja']
 
@@ -472,11 +820,27 @@ class CMakeBuilder(Builder):
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
         env = self.env
-        utils.create_script(self.output_dir / 'cmake_invocation.sh', cmake_cmd, env)
-        utils.check_call(cmake_cmd, cwd=self.output_dir, env=env)
-
-        self._ninja(self.ninja_targets)
-        self.install_config()
+        # Skip configure if nothing changed since the last successful one.
+        # Ninja still reruns cmake if any of the CMake files it knows about
+        # changed.
+        hash_file = self.output_dir / 'cmake_invocation.hash'
+        if self.remove_cmake_cache or not (self.output_dir / 'build.ninja').exists():
+            hash_file.unlink(missing_ok=True)
+        if hash_file.exists() and hash_file.read_text() == self._cmake_hash(cmake_cmd, env):
+            logger().info('Skipping cmake for %s: configuration is unchanged', self.name)
+        else:
+            hash_file.unlink(missing_ok=True)
+            with timer.Timer(f'{self.step_name}_configure', parent=self.step_name):
+                self._configure(cmake_cmd, env)
+            hash_file.write_text(self._cmake_hash(cmake_cmd, env))
+
+        with timer.Timer(f'{self.step_name}_ninja', parent=self.step_name):
+            self._ninja(self.ninja_targets)
+        with timer.Timer(f'{self.step_name}_install', parent=self.step_name):
+            # Concurrent configs may install into the same dir, e.g. the
+            # clang resource dir, and overwrite the same headers.
+            with utils.dir_lock(self.install_dir):
+                self.install_config()
 
     def install_config(self) -> None:
         """Installs built artifacts for current config."""
@@ -526,6 +890,50 @@ class LLVMRuntimeBuilder(LLVMBaseBuilder):  # pylint: disable=abstract-method
     """Base builder for llvm runtime libs."""
 
     _config: configs.AndroidConfig
+    intermediate_output_dir: bool = True
+    share_cmake_checks: bool = True
+
+    """Source dirs besides src_dir that configs read, e.g. shared CMake modules."""
+    remote_source_dirs: List[Path] = [paths.LLVM_PATH / 'cmake', paths.LLVM_PATH / 'llvm' / 'cmake']
+
+    @property
+    def remote_inputs(self) -> List[Path]:
+        return [self.src_dir, *self.remote_source_dirs, self.toolchain.path, self._config.sysroot]
+
+    @property
+    def remote_outputs(self) -> List[Path]:
+        return [self.output_toolchain.path, self.install_dir]
+
+    @property
+    def output_dir(self) -> Path:
+        output_dir = super().output_dir
+        if tmpfs_dirs := tmpfs.get():
+            return tmpfs_dirs.place(self.name, output_dir)
+        return output_dir
+
+    def _build_config(self) -> None:
+        tmpfs_dirs = tmpfs.get()
+        build_dir = self.output_dir
+        if tmpfs_dirs is None or not tmpfs_dirs.is_placed(build_dir):
+            super()._build_config()
+            return
+        try:
+            super()._build_config()
+        except (OSError, subprocess.CalledProcessError) as e:
+            if not tmpfs_dirs.fall_back(super().output_dir, build_dir, e):
+                raise
+            super()._build_config()
+        # Everything is installed outside of the build dir by now.
+        tmpfs_dirs.release(build_dir)
+
+    @property
+    def staging_install_dir(self) -> Path:
+        """An install dir next to the build dir in OUT_DIR, for installs copied elsewhere.
+
+        Unlike the build dir, it's never on the tmpfs, which only frees build dirs.
+        """
+        output_dir = super().output_dir
+        return output_dir.parent / (output_dir.name + '-install')
 
     @property
     def install_dir(self) -> Path:
@@ -562,6 +970,11 @@ class LLVMBuilder(LLVMBaseBuilder):
     libzstd: Optional[LibInfo] = None
     runtimes_triples: List[str] = list()
     build_32bit_runtimes: bool = False
+    # Number of lit workers in test(), or None to let lit use all cores.
+    test_jobs: Optional[int] = None
+    # Linux host configs to build runtimes for besides the builder's own, e.g.
+    # musl in a glibc stage1 that builds a musl stage2.
+    extra_runtime_configs: List[configs.Config] = list()
 
     # lldb options.
     build_lldb: bool = True
@@ -584,6 +997,12 @@ class LLVMBuilder(LLVMBaseBuilder):
         """Returns enabled llvm projects."""
         raise NotImplementedError()
 
+    @property
+    def builds_musl_runtimes(self) -> bool:
+        """Whether runtimes are built for a musl host."""
+        return any(isinstance(config, configs.LinuxMuslConfig)
+                   for config in [self._config] + self.extra_runtime_configs)
+
     @property
     def llvm_runtime_projects(self) -> Set[str]:
         """Returns enabled llvm runtimes."""
@@ -645,18 +1064,15 @@ class LLVMBuilder(LLVMBaseBuilder):
         for lib in (self.liblzma, self.libedit, self.libxml2, self.libncurses):
             if lib:
                 for lib_file in lib.install_libraries:
-                    shutil.copy2(lib_file, lib_dir)
+                    utils.copy_file(lib_file, lib_dir)
                 for link in lib.symlinks:
-                    # cannot copy to an existing symlink pointing to the source file
-                    dest_file = lib_dir / link.name
-                    dest_file.unlink(missing_ok=True)
-                    shutil.copy2(link, dest_file, follow_symlinks=False)
+                    utils.copy_file(link, lib_dir / link.name, follow_symlinks=False)
                 if bin_dir:
                     for tool in lib.install_tools:
-                        shutil.copy2(tool, bin_dir)
+                        utils.copy_file(tool, bin_dir)
 
         if isinstance(self._config, configs.LinuxMuslConfig):
-            shutil.copy2(self._config.sysroot / 'lib' / 'libc_musl.so', lib_dir / 'libc_musl.so')
+            utils.copy_file(self._config.sysroot / 'lib' / 'libc_musl.so', lib_dir / 'libc_musl.so')
 
     def _setup_install_dir(self) -> None:
         lib_dir = self.install_dir / ('bin' if self._config.target_os.is_windows else 'lib')
@@ -684,7 +1100,10 @@ class LLVMBuilder(LLVMBaseBuilder):
         if self.use_sccache:
             defines['CMAKE_C_COMPILER_LAUNCHER'] = 'sccache'
             defines['CMAKE_CXX_COMPILER_LAUNCHER'] = 'sccache'
-            defines['LLVM_PARALLEL_COMPILE_JOBS'] = int(multiprocessing.cpu_count()) * 10
+            if server := jobserver.get():
+                defines['LLVM_PARALLEL_COMPILE_JOBS'] = server.tokens
+            else:
+                defines['LLVM_PARALLEL_COMPILE_JOBS'] = int(multiprocessing.cpu_count()) * 10
 
         defines['LLVM_ENABLE_PROJECTS'] = ';'.join(sorted(self.llvm_projects))
         defines['LLVM_ENABLE_RUNTIMES'] = ';'.join(sorted(self.llvm_runtime_projects))
@@ -735,7 +1154,7 @@ class LLVMBuilder(LLVMBaseBuilder):
             defines['RUNTIMES_CMAKE_ARGS'] = ';'.join(sorted(runtimes_cmake_args))
 
         if self._config.target_os.is_linux:
-            runtime_configs = [self._config]
+            runtime_configs = [self._config] + self.extra_runtime_configs
             if self.build_32bit_runtimes:
                 if self._config.is_musl:
                     runtime_configs.append(configs.LinuxMuslHostConfig(hosts.Arch.I386))
@@ -790,6 +1209,10 @@ class LLVMBuilder(LLVMBaseBuilder):
                 # Don't depend on the host libatomic library.
                 defines[f'RUNTIMES_{triple}_LIBCXX_HAS_ATOMIC_LIB'] = 'NO'
 
+                # libunwind is only built for musl. Keep the glibc unwinder for glibc.
+                if 'libunwind' in self.llvm_runtime_projects and not _config.is_musl:
+                    defines[f'RUNTIMES_{triple}_LIBCXXABI_USE_LLVM_UNWINDER'] = 'OFF'
+
                 # Make libc++.so a symlink to libc++.so.x instead of a linker script that
                 # also adds -lc++abi.  Statically link libc++abi to libc++ so it is not
                 # necessary to pass -lc++abi explicitly.  This is needed only for Linux.
@@ -828,18 +1251,38 @@ class LLVMBuilder(LLVMBaseBuilder):
 
     def build(self) -> None:
         super().build()
-        if self.use_sccache:
+        if self.use_sccache and not build_plan.get():
             utils.check_call(['sccache', '--show-stats'])
 
 
+    def _ninja_check(self, targets: List[str],
+                     add_env: Optional[Dict[str, str]] = None) -> None:
+        """Builds check targets, with test_jobs lit workers if set.
+
+        lit doesn't use the jobserver, so its workers hold jobserver tokens
+        while it runs.
+        """
+        if not self.test_jobs:
+            self._ninja(targets, add_env)
+            return
+        env = dict(add_env or {})
+        env['LIT_OPTS'] = ' '.join(filter(None, [self.env.get('LIT_OPTS'),
+                                                 f'-j{self.test_jobs}']))
+        server = jobserver.get()
+        if server is None:
+            self._ninja(targets, env)
+            return
+        with server.reserve(self.test_jobs - 1):
+            self._ninja(targets, env)
+
     def test(self) -> None:
-        with timer.Timer(f'stage2_test'):
-            # newer test tools like dexp, clang-query, c-index-test
-            # need libedit.so.*, libxml2.so.*, etc. in stage2/lib.
-            self._install_lib_deps(self.output_dir / 'lib')
-            self._ninja(
-                ['check-clang', 'check-llvm', 'check-clang-tools'] +
-                ['check-cxx-' + triple for triple in sorted(self.runtimes_triples)])
+        # do_build.py times the tests as a journal step.
+        # newer test tools like dexp, clang-query, c-index-test
+        # need libedit.so.*, libxml2.so.*, etc. in stage2/lib.
+        self._install_lib_deps(self.output_dir / 'lib')
+        self._ninja_check(
+            ['check-clang', 'check-llvm', 'check-clang-tools'] +
+            ['check-cxx-' + triple for triple in sorted(self.runtimes_triples)])
         # Known failed tests:
         #   Clang :: CodeGenCXX/builtins.cpp
         #   Clang :: CodeGenCXX/unknown-anytype.cpp
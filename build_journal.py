@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A journal of completed build steps, used to resume failed builds."""
+
+import json
+import logging
+from pathlib import Path
+import threading
+from typing import Callable, Dict, Optional, Union
+
+import build_plan
+import timer
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+# A fingerprint, or a function that computes it when it's needed.
+Fingerprint = Union[str, Callable[[], str]]
+
+
+class BuildJournal:
+    """Records completed build steps and the fingerprints of their inputs.
+
+    When resuming, a step is skipped if an earlier build completed it with the
+    same fingerprint. Once a step runs, the steps after it may depend on its
+    new outputs, so they all run again.
+
+    Every build records the fingerprints of the steps it completes, so a
+    failed build can be resumed. They are computed when the step runs; the
+    flags, CMake defines and source hashes behind them are memoized.
+    """
+
+    def __init__(self, path: Optional[Path], resume: bool = False) -> None:
+        self.path = path
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._previous: Dict[str, str] = self._load() if resume else {}
+        # Set once a step runs in this build, so later steps can't be skipped.
+        self._dirty: bool = not resume
+        # Steps completed or skipped in this build.
+        self._steps: Dict[str, str] = {}
+        self._save()
+
+    def _load(self) -> Dict[str, str]:
+        if self.path is None:
+            return {}
+        try:
+            with self.path.open() as journal_file:
+                return json.load(journal_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.parent / (self.path.name + '.tmp')
+        with tmp_path.open('w') as journal_file:
+            json.dump(self._steps, journal_file, indent=2, sort_keys=True)
+        tmp_path.replace(self.path)
+
+    @staticmethod
+    def _fingerprint(fingerprint: Fingerprint) -> str:
+        return fingerprint() if callable(fingerprint) else fingerprint
+
+    def is_done(self, step: str, fingerprint: Fingerprint) -> bool:
+        """Tests whether step can be skipped."""
+        if not self.resume:
+            return False
+        fingerprint = self._fingerprint(fingerprint)
+        with self._lock:
+            return not self._dirty and self._previous.get(step) == fingerprint
+
+    def run(self, step: str, fingerprint: Fingerprint, function: Callable[[], None]) -> None:
+        """Runs and times function as step, unless an earlier build completed it."""
+        if plan := build_plan.get():
+            plan.record_step(step)
+            return
+        fingerprint = self._fingerprint(fingerprint)
+        with self._lock:
+            if not self._dirty and self._previous.get(step) == fingerprint:
+                logger().info('Skipping %s: completed by an earlier build', step)
+                self._steps[step] = fingerprint
+                self._save()
+                return
+            self._dirty = True
+            self._steps.pop(step, None)
+            self._save()
+        with timer.Timer(step):
+            function()
+        with self._lock:
+            self._steps[step] = fingerprint
+            self._save()
+
+
+_journal: BuildJournal = BuildJournal(None)
+
+
+def start(path: Path, resume: bool) -> BuildJournal:
+    """Starts the journal of this build, resuming the journal at path if resume is set."""
+    global _journal  # pylint: disable=global-statement
+    _journal = BuildJournal(path, resume)
+    logger().info('%s build journal %s', 'Resuming' if resume else 'Starting', path)
+    return _journal
+
+
+def get() -> BuildJournal:
+    """Returns the journal of this build. Steps always run if it wasn't started."""
+    return _journal
@@ -0,0 +1,247 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Plans a build without running it, with an ETA from earlier build times."""
+
+import contextlib
+from datetime import timedelta
+import logging
+from pathlib import Path
+import re
+import statistics
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+def load_times(files: Iterable[Path]) -> Dict[str, float]:
+    """Returns the median duration of each step in build_times.txt files."""
+    samples: Dict[str, List[float]] = {}
+    line_re = re.compile(r'(?:(\d+) days?, )?(\d+):(\d\d):(\d\d) (.*)')
+    for times_file in files:
+        if not times_file.exists():
+            logger().warning('Missing build times file %s', times_file)
+            continue
+        for line in times_file.read_text().splitlines():
+            match = line_re.fullmatch(line)
+            if not match:
+                continue
+            days, hours, minutes, seconds, step = match.groups()
+            duration = timedelta(days=int(days or 0), hours=int(hours),
+                                 minutes=int(minutes), seconds=int(seconds))
+            samples.setdefault(step, []).append(duration.total_seconds())
+    return {step: statistics.median(durations) for step, durations in samples.items()}
+
+
+def _simulate(jobs: int, durations: List[float],
+              deps: List[Set[int]]) -> Tuple[float, List[int]]:
+    """Simulates running tasks on jobs slots, like scheduler.Scheduler.
+
+    Returns the total duration and the indices of the tasks on the critical
+    path, i.e. the chain of tasks that each waited for the previous one. A
+    task waited for the dependency that finished last, or, if it had to wait
+    for a free slot after that, for the task that freed the slot.
+    """
+    done: Set[int] = set()
+    pending = list(range(len(durations)))
+    running: List[Tuple[float, int]] = []
+    pred: Dict[int, Optional[int]] = {}
+    finish: Dict[int, float] = {}
+    now = 0.0
+    last: Optional[int] = None
+    while pending or running:
+        for index in list(pending):
+            if len(running) >= jobs:
+                break
+            if deps[index] <= done:
+                pending.remove(index)
+                gate = max(deps[index], key=lambda dep: finish[dep], default=None)
+                if last is not None and (gate is None or finish[gate] < now):
+                    # Waited for a slot rather than for its dependencies.
+                    gate = last
+                pred[index] = gate
+                running.append((now + durations[index], index))
+        running.sort()
+        now, last = running.pop(0)
+        finish[last] = now
+        done.add(last)
+    if not finish:
+        return 0.0, []
+    path: List[int] = []
+    index: Optional[int] = max(finish, key=lambda i: finish[i])
+    while index is not None:
+        path.append(index)
+        index = pred[index]
+    return max(finish.values()), path[::-1]
+
+
+class PlanStep:
+    """A build step, timed as name in build_times.txt."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class PlanBuilder:
+    """The configs of a builder, built config_jobs at a time."""
+
+    def __init__(self, name: str, configs: List[str], config_jobs: int) -> None:
+        self.name = name
+        self.configs = [PlanStep(config) for config in configs]
+        self.config_jobs = config_jobs
+
+
+class PlanTask:
+    """A task of a scheduler, running its items in order."""
+
+    def __init__(self, name: str, deps: Iterable[str]) -> None:
+        self.name = name
+        self.deps = set(deps)
+        self.items: List['PlanItem'] = []
+
+
+class PlanGroup:
+    """Tasks run by a scheduler with at most max_jobs tasks at a time."""
+
+    def __init__(self, max_jobs: int) -> None:
+        self.max_jobs = max_jobs
+        self.tasks: List[PlanTask] = []
+
+
+PlanItem = Union[PlanStep, PlanBuilder, PlanGroup]
+
+
+class Plan:
+    """Records the steps a build would run, instead of running them."""
+
+    def __init__(self, times: Dict[str, float]) -> None:
+        self.times = times
+        self.items: List[PlanItem] = []
+        self._stack: List[List[PlanItem]] = [self.items]
+        self._unknown: Set[str] = set()
+
+    def record_step(self, name: str) -> None:
+        """Records a step that would run."""
+        self._stack[-1].append(PlanStep(name))
+
+    def record_builder(self, builder) -> None:
+        """Records the configs of builder that would be built."""
+        config_jobs = builder.config_jobs if builder.concurrent_configs else 1
+        self._stack[-1].append(PlanBuilder(
+            builder.name, [builder.config_view(config).step_name
+                           for config in builder.config_list],
+            config_jobs))
+
+    @contextlib.contextmanager
+    def group(self, max_jobs: int) -> Iterator[PlanGroup]:
+        """Records the tasks of a scheduler."""
+        group = PlanGroup(max_jobs)
+        self._stack[-1].append(group)
+        yield group
+
+    @contextlib.contextmanager
+    def task(self, group: PlanGroup, name: str, deps: Iterable[str]) -> Iterator[None]:
+        """Records the items run by a task of group."""
+        task = PlanTask(name, deps)
+        group.tasks.append(task)
+        self._stack.append(task.items)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+
+    def _duration(self, step: PlanStep) -> float:
+        if step.name not in self.times:
+            self._unknown.add(step.name)
+        return self.times.get(step.name, 0.0)
+
+    def _estimate(self, items: List[PlanItem]) -> Tuple[float, List[str]]:
+        """Returns the duration and critical path of items run in order."""
+        total = 0.0
+        path: List[str] = []
+        for item in items:
+            if isinstance(item, PlanStep):
+                total += self._duration(item)
+                path.append(item.name)
+            elif isinstance(item, PlanBuilder):
+                durations = [self._duration(config) for config in item.configs]
+                duration, indices = _simulate(item.config_jobs, durations,
+                                              [set() for _ in durations])
+                total += duration
+                path.extend(item.configs[index].name for index in indices)
+            else:
+                names = [task.name for task in item.tasks]
+                estimates = [self._estimate(task.items) for task in item.tasks]
+                deps = [{names.index(dep) for dep in task.deps if dep in names}
+                        for task in item.tasks]
+                duration, indices = _simulate(item.max_jobs,
+                                              [estimate[0] for estimate in estimates], deps)
+                total += duration
+                for index in indices:
+                    path.extend(estimates[index][1])
+        return total, path
+
+    @staticmethod
+    def _format(seconds: float) -> str:
+        return str(timedelta(seconds=int(seconds)))
+
+    def _lines(self, items: List[PlanItem], indent: str) -> Iterator[str]:
+        for item in items:
+            if isinstance(item, PlanStep):
+                yield f'{indent}{self._format(self._estimate([item])[0])} {item.name}'
+            elif isinstance(item, PlanBuilder):
+                yield f'{indent}{self._format(self._estimate([item])[0])} {item.name}' + (
+                    f' ({item.config_jobs} configs at a time)' if item.config_jobs > 1 else '')
+                for config in item.configs:
+                    yield f'{indent}    {self._format(self._duration(config))} {config.name}'
+            else:
+                yield (f'{indent}{self._format(self._estimate([item])[0])} '
+                       f'{len(item.tasks)} tasks, {item.max_jobs} at a time:')
+                for task in item.tasks:
+                    deps = f' (after {", ".join(sorted(task.deps))})' if task.deps else ''
+                    yield f'{indent}    {task.name}{deps}'
+                    yield from self._lines(task.items, indent + '        ')
+
+    def report(self) -> str:
+        """Returns the planned steps, the total ETA and the critical path."""
+        self._unknown.clear()
+        lines = ['Build plan:']
+        lines.extend(self._lines(self.items, '  '))
+        total, path = self._estimate(self.items)
+        lines.append(f'Total ETA: {self._format(total)}')
+        lines.append('Critical path:')
+        lines.extend(f'  {self._format(self.times.get(step, 0.0))} {step}' for step in path)
+        if self._unknown:
+            lines.append('No earlier timing for (counted as 0:00:00):')
+            lines.extend(f'  {step}' for step in sorted(self._unknown))
+        return '\n'.join(lines)
+
+
+_plan: Optional[Plan] = None
+
+
+def start(times: Dict[str, float]) -> Plan:
+    """Switches to planning: steps are recorded instead of run."""
+    global _plan  # pylint: disable=global-statement
+    _plan = Plan(times)
+    return _plan
+
+
+def get() -> Optional[Plan]:
+    """Returns the plan being recorded, or None when building."""
+    return _plan
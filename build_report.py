@@ -0,0 +1,213 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Reports the timeline, critical path and core utilization of a build."""
+
+import atexit
+from datetime import timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import timer
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class CpuSampler:
+    """Samples how many cores of the host are busy, from /proc/stat."""
+
+    def __init__(self, interval: float = 2.0) -> None:
+        self.interval = interval
+        self.cores = os.cpu_count() or 1
+        # (time, busy cores over the interval ending at time)
+        self.samples: List[Tuple[float, float]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _read() -> Optional[Tuple[int, int]]:
+        """Returns the total and idle jiffies of all cores."""
+        try:
+            with open('/proc/stat') as stat_file:
+                fields = [int(field) for field in stat_file.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        # idle and iowait
+        return sum(fields), fields[3] + fields[4]
+
+    def _run(self) -> None:
+        previous = self._read()
+        while previous is not None and not self._stop.wait(self.interval):
+            current = self._read()
+            if current is None:
+                return
+            total = current[0] - previous[0]
+            idle = current[1] - previous[1]
+            if total > 0:
+                self.samples.append((time.time(), (total - idle) / total * self.cores))
+            previous = current
+
+    def start(self) -> None:
+        """Starts sampling in a background thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops sampling."""
+        self._stop.set()
+
+    def busy_cores(self, start: float, end: float) -> Optional[float]:
+        """Returns the average number of busy cores between start and end."""
+        # A sample covers the interval before its time.
+        samples = [busy for sample_time, busy in self.samples
+                   if start < sample_time <= end + self.interval]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+
+def _span_info(name: str, start: float, end: float, build_start: float,
+               sampler: CpuSampler) -> Dict[str, Any]:
+    return {
+        'name': name,
+        'start': start - build_start,
+        'end': end - build_start,
+        'duration': end - start,
+        'busy_cores': sampler.busy_cores(start, end),
+    }
+
+
+def analyze(spans: Dict[str, Tuple[float, float, Optional[str]]],
+            deps: Dict[str, List[str]], sampler: CpuSampler) -> Dict[str, Any]:
+    """Returns the timeline, critical path and utilization of timed spans.
+
+    deps lists the steps each step waited for, see timer.Timer.deps.
+    """
+    if not spans:
+        return {'cores': sampler.cores, 'timeline': [], 'critical_path': [], 'idle': []}
+    build_start = min(start for start, _, _ in spans.values())
+    build_end = max(end for _, end, _ in spans.values())
+
+    steps = {name: span for name, span in spans.items() if span[2] is None}
+    timeline = []
+    for name, (start, end, _) in sorted(steps.items(), key=lambda item: item[1][0]):
+        step = _span_info(name, start, end, build_start, sampler)
+        step['after'] = [dep for dep in deps.get(name, []) if dep in steps]
+        step['phases'] = [
+            _span_info(phase, phase_start, phase_end, build_start, sampler)
+            for phase, (phase_start, phase_end, parent) in sorted(
+                spans.items(), key=lambda item: item[1][0])
+            if parent == name]
+        timeline.append(step)
+
+    # The longest path through the steps and the steps they waited for, by
+    # duration. Steps finish after the steps they waited for, so visiting
+    # them by end time visits those first.
+    longest: Dict[str, float] = {}
+    preds: Dict[str, Optional[str]] = {}
+    for name in sorted(steps, key=lambda name: steps[name][1]):
+        after = [dep for dep in deps.get(name, []) if dep in longest]
+        preds[name] = max(after, key=lambda dep: longest[dep], default=None)
+        longest[name] = (steps[name][1] - steps[name][0] +
+                         (longest[preds[name]] if preds[name] else 0.0))
+    critical_path: List[Dict[str, Any]] = []
+    current: Optional[str] = max(longest, key=lambda name: longest[name]) if longest else None
+    while current is not None:
+        start = steps[current][0]
+        pred = preds[current]
+        info = _span_info(current, *steps[current][:2], build_start, sampler)
+        # Time not covered by any timed step, e.g. untimed work in do_build.py.
+        info['wait'] = start - (steps[pred][1] if pred else build_start)
+        critical_path.append(info)
+        current = pred
+    critical_path.reverse()
+
+    # Phases, or steps without phases, by the core time they left idle.
+    idle = []
+    for step in timeline:
+        for span in step['phases'] or [step]:
+            if span['busy_cores'] is not None:
+                span = dict(span, idle_core_seconds=(
+                    (sampler.cores - span['busy_cores']) * span['duration']))
+                idle.append(span)
+    idle.sort(key=lambda span: span['idle_core_seconds'], reverse=True)
+
+    return {
+        'cores': sampler.cores,
+        'duration': build_end - build_start,
+        'busy_cores': sampler.busy_cores(build_start, build_end),
+        'timeline': timeline,
+        'critical_path': critical_path,
+        'idle': idle,
+    }
+
+
+def _format_time(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
+
+
+def _format_cores(busy: Optional[float], cores: int) -> str:
+    return f'{busy:5.1f}/{cores}' if busy is not None else f'    ?/{cores}'
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Returns a text summary of analyze()."""
+    cores = report['cores']
+    lines = ['Timeline (start, duration, busy cores, step):']
+    for step in report['timeline']:
+        lines.append(f'  {_format_time(step["start"])} {_format_time(step["duration"])} '
+                     f'{_format_cores(step["busy_cores"], cores)} {step["name"]}')
+        for phase in step['phases']:
+            lines.append(f'      {_format_time(phase["duration"])} '
+                         f'{_format_cores(phase["busy_cores"], cores)} {phase["name"]}')
+    if report['timeline']:
+        lines.append(f'Total: {_format_time(report["duration"])}, '
+                     f'{_format_cores(report["busy_cores"], cores)} busy cores on average')
+    lines.append('Critical path (wait before step, duration, busy cores, step):')
+    for step in report['critical_path']:
+        lines.append(f'  {_format_time(step["wait"])} {_format_time(step["duration"])} '
+                     f'{_format_cores(step["busy_cores"], cores)} {step["name"]}')
+    lines.append('Most idle phases (idle core-hours, duration, busy cores, phase):')
+    for span in report['idle'][:20]:
+        lines.append(f'  {span["idle_core_seconds"] / 3600:7.1f} '
+                     f'{_format_time(span["duration"])} '
+                     f'{_format_cores(span["busy_cores"], cores)} {span["name"]}')
+    return '\n'.join(lines)
+
+
+def write_report(sampler: CpuSampler, dist_dir: Path) -> None:
+    """Writes build_report.txt and build_report.json to dist_dir."""
+    sampler.stop()
+    report = analyze(timer.Timer.spans, timer.Timer.deps, sampler)
+    text = format_report(report)
+    logger().info('Build report:\n%s', text)
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    (dist_dir / 'build_report.txt').write_text(text)
+    with (dist_dir / 'build_report.json').open('w') as json_file:
+        json.dump(report, json_file, indent=2)
+
+
+def register_atexit(dist_dir: Path) -> None:
+    """Starts sampling core utilization, and writes the report at exit."""
+    sampler = CpuSampler()
+    sampler.start()
+    atexit.register(write_report, sampler, dist_dir)
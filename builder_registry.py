@@ -31,6 +31,19 @@ class BuilderRegistry:
     # A lambda to decide whether we should build or skip a builder."""
     _filters: List[Callable[[str], bool]] = []
 
+    # Targets that build a variant of another one, e.g. stage2-musl of stage2.
+    _variants: Dict[str, str] = dict()
+
+    @classmethod
+    def add_variant(cls, name: str, base_name: str) -> None:
+        """Lets builds and skips of base_name also apply to its variant name."""
+        cls._variants[name] = base_name
+
+    @classmethod
+    def base_name(cls, name: str) -> str:
+        """Returns the name of the target that name is a variant of, or name itself."""
+        return cls._variants.get(name, name)
+
     @classmethod
     def add_filter(cls, new_filter: Callable[[str], bool]) -> None:
         """Adds a filter function. A target will be built if all filters return true."""
@@ -40,13 +53,13 @@ class BuilderRegistry:
     def add_builds(cls, builds: Iterable[str]) -> None:
         """Adds a filter to only allow listed targets."""
         build_set = set(builds)
-        cls.add_filter(lambda name: name in build_set)
+        cls.add_filter(lambda name: name in build_set or cls.base_name(name) in build_set)
 
     @classmethod
     def add_skips(cls, skips: Iterable[str]) -> None:
         """Adds a filter to not allow listed targets."""
         skip_set = set(skips)
-        cls.add_filter(lambda name: name not in skip_set)
+        cls.add_filter(lambda name: name not in skip_set and cls.base_name(name) not in skip_set)
 
     @classmethod
     def should_build(cls, name: str) -> bool:
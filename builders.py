@@ -16,26 +16,40 @@
 """Builder instances for various targets."""
 
 from pathlib import Path
-from typing import cast, Dict, Iterator, List, Optional, Set
+from typing import Any, cast, Dict, Iterator, List, Optional, Set
 import contextlib
+import logging
 import os
 import re
 import shutil
 import textwrap
-import timer
+import threading
 
 import base_builders
+import build_plan
 import configs
 import constants
+import deletion_service
 import hosts
 import mapfile
 import multiprocessing
 import paths
+import resources
+import source_manager
+import sys
+import thinlto_cache
 import utils
 
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
 class SanitizerMapFileBuilder(base_builders.Builder):
     name: str = 'sanitizer-mapfile'
     config_list: List[configs.Config] = configs.android_configs()
+    depends_on: List[str] = ['compiler-rt']
 
     def _build_config(self) -> None:
         arch = self._config.target_arch
@@ -61,6 +75,12 @@ class Stage1Builder(base_builders.LLVMBuilder):
     install_dir: Path = paths.OUT_DIR / 'stage1-install'
     build_android_targets: bool = False
     build_extra_tools: bool = False
+    cacheable: bool = True
+
+    @property
+    def cache_artifacts(self) -> List[Path]:
+        # Later builders use tablegen binaries from the build dir.
+        return super().cache_artifacts + [self.output_dir / 'bin']
 
     @property
     def llvm_targets(self) -> Set[str]:
@@ -85,7 +105,7 @@ class Stage1Builder(base_builders.LLVMBuilder):
     @property
     def llvm_runtime_projects(self) -> Set[str]:
         proj = {'compiler-rt', 'libcxx', 'libcxxabi'}
-        if isinstance(self._config, configs.LinuxMuslConfig):
+        if self.builds_musl_runtimes:
             # libcxx builds against libunwind when building for musl
             proj.add('libunwind')
         return proj
@@ -123,8 +143,12 @@ class Stage1Builder(base_builders.LLVMBuilder):
         return defines
 
     def test(self) -> None:
-        with timer.Timer(f'stage1_test'):
-            self._ninja(['check-clang', 'check-llvm', 'check-clang-tools'])
+        if self.fetched_from_cache:
+            # Only the install dir and build/bin are cached.
+            logger().info('Skipping stage1 tests: fetched from the artifact cache, '
+                          'without a build tree')
+            return
+        self._ninja(['check-clang', 'check-llvm', 'check-clang-tools'])
         # stage1 cannot run check-cxx yet
 
 
@@ -139,6 +163,17 @@ class Stage2Builder(base_builders.LLVMBuilder):
     profdata_file: Optional[Path] = None
     lto: bool = False
 
+    """Number of stage2 builds that run, and link, at the same time."""
+    concurrent_builds: int = 1
+
+    @property
+    def thin_lto(self) -> bool:
+        """Whether LLVM is built with ThinLTO."""
+        return (self.lto and
+                not self._config.target_os.is_darwin and
+                not self.build_instrumented and
+                not self.debug_build)
+
     @property
     def llvm_targets(self) -> Set[str]:
         return constants.ANDROID_TARGETS
@@ -153,7 +188,7 @@ class Stage2Builder(base_builders.LLVMBuilder):
     @property
     def llvm_runtime_projects(self) -> Set[str]:
         proj = {'compiler-rt', 'libcxx', 'libcxxabi'}
-        if isinstance(self._config, configs.LinuxMuslConfig):
+        if self.builds_musl_runtimes:
             # libcxx builds against libunwind when building for musl
             proj.add('libunwind')
         return proj
@@ -189,6 +224,8 @@ class Stage2Builder(base_builders.LLVMBuilder):
             ldflags.append('-Wl,--icf=safe')
         if self.lto and self.enable_mlgo:
             ldflags.append('-Wl,-mllvm,-regalloc-enable-advisor=release')
+        if self.thin_lto and (cache := thinlto_cache.get()):
+            ldflags.extend(cache.ldflags)
         return ldflags
 
     @property
@@ -206,14 +243,19 @@ class Stage2Builder(base_builders.LLVMBuilder):
         defines = super().cmake_defines
         defines['CLANG_PYTHON_BINDINGS_VERSIONS'] = '3'
 
-        if (self.lto and
-                not self._config.target_os.is_darwin and
-                not self.build_instrumented and
-                not self.debug_build):
+        if self.thin_lto:
             defines['LLVM_ENABLE_LTO'] = 'Thin'
 
-            # Increase the ThinLTO link jobs limit to improve build speed.
-            defines['LLVM_PARALLEL_LINK_JOBS'] = min(int(multiprocessing.cpu_count() / 2), 16)
+            # ThinLTO links are memory bound. Run as many as the available
+            # memory allows, based on the peak RSS of links in earlier builds,
+            # and record the peak RSS of the links of this build.
+            defines['LLVM_PARALLEL_LINK_JOBS'] = resources.link_jobs(
+                self.link_rss_history, int(multiprocessing.cpu_count() / 2),
+                self.concurrent_builds)
+            launcher = ';'.join([sys.executable, str(paths.SCRIPTS_DIR / 'link_rss.py'),
+                                 str(self.link_rss_log)])
+            defines['CMAKE_C_LINKER_LAUNCHER'] = launcher
+            defines['CMAKE_CXX_LINKER_LAUNCHER'] = launcher
 
         # Build libFuzzer here to be exported for the host fuzzer builds. libFuzzer
         # is not currently supported on Darwin.
@@ -246,6 +288,30 @@ class Stage2Builder(base_builders.LLVMBuilder):
 
         return defines
 
+    @property
+    def link_rss_history(self) -> resources.PeakRssHistory:
+        """Peak RSS of the links of previous builds."""
+        return resources.PeakRssHistory(paths.OUT_DIR / 'link_rss_history.json')
+
+    @property
+    def link_rss_log(self) -> Path:
+        """Log of the peak RSS of the links of this build."""
+        return self.output_dir / 'link_rss.log'
+
+    def _build_config(self) -> None:
+        if self.thin_lto and (cache := thinlto_cache.get()):
+            cache.link(self.output_dir)
+        super()._build_config()
+
+    def build(self) -> None:
+        try:
+            super().build()
+        finally:
+            # Keep the measurements even if a link failed, e.g. because it was
+            # killed for running out of memory. A plan links nothing.
+            if not build_plan.get():
+                self.link_rss_history.merge_log(self.link_rss_log)
+
     def install_config(self) -> None:
         super().install_config()
         lldb_wrapper_path = self.install_dir / 'bin' / 'lldb.sh'
@@ -262,12 +328,11 @@ class Stage2Builder(base_builders.LLVMBuilder):
     def test(self) -> None:
         if isinstance(self._config, configs.LinuxMuslConfig):
             # musl cannot run check-cxx yet
-            with timer.Timer('stage2_test'):
-                self._ninja(['check-clang', 'check-llvm'])
-                # TUSchedulerTests.PreambleThrottle is flaky on buildbots for musl build.
-                # So disable it.
-                self._ninja(['check-clang-tools'],
-                            {'GTEST_FILTER': '-TUSchedulerTests.PreambleThrottle'})
+            self._ninja_check(['check-clang', 'check-llvm'])
+            # TUSchedulerTests.PreambleThrottle is flaky on buildbots for musl build.
+            # So disable it.
+            self._ninja_check(['check-clang-tools'],
+                              {'GTEST_FILTER': '-TUSchedulerTests.PreambleThrottle'})
         else:
             super().test()
 
@@ -275,6 +340,8 @@ class Stage2Builder(base_builders.LLVMBuilder):
 class BuiltinsBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'builtins'
     src_dir: Path = paths.LLVM_PATH / 'compiler-rt' / 'lib' / 'builtins'
+    depends_on: List[str] = ['device-sysroots']
+    concurrent_configs: bool = True
 
     # Only target the NDK, not the platform. The NDK copy is sufficient for the
     # platform builders, and both NDK+platform builders use the same toolchain,
@@ -367,6 +434,12 @@ class BuiltinsBuilder(base_builders.LLVMRuntimeBuilder):
 class CompilerRTBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'compiler-rt'
     src_dir: Path = paths.LLVM_PATH / 'compiler-rt'
+    depends_on: List[str] = ['device-sysroots', 'builtins', 'libunwind', 'platform-libcxxabi']
+    concurrent_configs: bool = True
+    remote_buildable: bool = True
+    # compiler-rt builds a private libc++ from these, e.g. for libFuzzer.
+    remote_source_dirs: List[Path] = base_builders.LLVMRuntimeBuilder.remote_source_dirs + [
+        paths.LLVM_PATH / 'libcxx', paths.LLVM_PATH / 'libcxxabi']
     config_list: List[configs.Config] = (
         configs.android_configs(platform=True) +
         configs.android_configs(platform=False)
@@ -377,8 +450,7 @@ class CompilerRTBuilder(base_builders.LLVMRuntimeBuilder):
         if self._config.platform:
             return self.output_toolchain.clang_lib_dir
         # Installs to a temporary dir and copies to runtimes_ndk_cxx manually.
-        output_dir = self.output_dir
-        return output_dir.parent / (output_dir.name + '-install')
+        return self.staging_install_dir
 
     @property
     def cmake_defines(self) -> Dict[str, str]:
@@ -435,7 +507,8 @@ class CompilerRTBuilder(base_builders.LLVMRuntimeBuilder):
 
         if not self._config.platform:
             dst_dir = self.output_toolchain.path / 'runtimes_ndk_cxx'
-            shutil.copytree(lib_dir, dst_dir, dirs_exist_ok=True)
+            with utils.dir_lock(dst_dir):
+                utils.copy_tree(lib_dir, dst_dir, dirs_exist_ok=True)
 
     def install(self) -> None:
         # Install libfuzzer headers once for all configs.
@@ -454,6 +527,8 @@ class CompilerRTBuilder(base_builders.LLVMRuntimeBuilder):
 class MuslHostRuntimeBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'compiler-rt-linux-musl'
     src_dir: Path = paths.LLVM_PATH / 'runtimes'
+    depends_on: List[str] = ['builtins']
+    concurrent_configs: bool = True
 
     config_list: List[configs.Config] = [
             configs.LinuxMuslConfig(hosts.Arch.X86_64),
@@ -514,6 +589,8 @@ class MuslHostRuntimeBuilder(base_builders.LLVMRuntimeBuilder):
 class LibUnwindBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'libunwind'
     src_dir: Path = paths.LLVM_PATH / 'runtimes'
+    depends_on: List[str] = ['device-sysroots', 'builtins']
+    concurrent_configs: bool = True
 
     # Build two copies of the builtins library:
     #  - A copy targeting the NDK with hidden symbols.
@@ -608,12 +685,16 @@ class LibUnwindBuilder(base_builders.LLVMRuntimeBuilder):
 class LibOMPBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'libomp'
     src_dir: Path = paths.LLVM_PATH / 'openmp'
+    depends_on: List[str] = ['device-sysroots', 'builtins', 'libunwind', 'platform-libcxxabi']
+    concurrent_configs: bool = True
+    remote_buildable: bool = True
 
     config_list: List[configs.Config] = (
         configs.android_configs(platform=True, extra_config={'is_shared': False}) +
         configs.android_configs(platform=False, extra_config={'is_shared': False}) +
         configs.android_configs(platform=False, extra_config={'is_shared': True})
     )
+    _header_lock = threading.Lock()
 
     @property
     def is_shared(self) -> bool:
@@ -650,14 +731,17 @@ class LibOMPBuilder(base_builders.LLVMRuntimeBuilder):
 
         # install omp.h, omp-tools.h (it's enough to do for just one config).
         if self._config.target_arch == hosts.Arch.AARCH64:
-            for header in ['omp.h', 'omp-tools.h']:
-                shutil.copy2(self.output_dir / 'runtime' / 'src' / header,
-                             self.output_toolchain.clang_builtin_header_dir)
+            # Several aarch64 configs may get here at the same time.
+            with self._header_lock:
+                for header in ['omp.h', 'omp-tools.h']:
+                    shutil.copy2(self.output_dir / 'runtime' / 'src' / header,
+                                 self.output_toolchain.clang_builtin_header_dir)
 
 
 class LibNcursesBuilder(base_builders.AutoconfBuilder, base_builders.LibInfo):
     name: str = 'libncurses'
     src_dir: Path = paths.LIBNCURSES_SRC_DIR
+    cacheable: bool = True
 
     @property
     def config_flags(self) -> List[str]:
@@ -673,6 +757,7 @@ class LibNcursesBuilder(base_builders.AutoconfBuilder, base_builders.LibInfo):
 class LibEditBuilder(base_builders.AutoconfBuilder, base_builders.LibInfo):
     name: str = 'libedit'
     src_dir: Path = paths.LIBEDIT_SRC_DIR
+    cacheable: bool = True
 
     @property
     def ldflags(self) -> List[str]:
@@ -693,6 +778,7 @@ class LibEditBuilder(base_builders.AutoconfBuilder, base_builders.LibInfo):
 class SwigBuilder(base_builders.AutoconfBuilder):
     name: str = 'swig'
     src_dir: Path = paths.SWIG_SRC_DIR
+    cacheable: bool = True
 
     @property
     def config_flags(self) -> List[str]:
@@ -712,6 +798,7 @@ class SwigBuilder(base_builders.AutoconfBuilder):
 class XzBuilder(base_builders.CMakeBuilder, base_builders.LibInfo):
     name: str = 'liblzma'
     src_dir: Path = paths.XZ_SRC_DIR
+    cacheable: bool = True
     static_lib: bool = True
 
     @property
@@ -730,6 +817,7 @@ class XzBuilder(base_builders.CMakeBuilder, base_builders.LibInfo):
 class ZstdBuilder(base_builders.CMakeBuilder, base_builders.LibInfo):
     name: str = 'libzstd'
     src_dir: Path = paths.ZSTD_SRC_DIR / 'build' / 'cmake'
+    cacheable: bool = True
     with_lib_version: bool = False
 
     @property
@@ -756,6 +844,9 @@ class ZstdBuilder(base_builders.CMakeBuilder, base_builders.LibInfo):
 class LibXml2Builder(base_builders.CMakeBuilder, base_builders.LibInfo):
     name: str = 'libxml2'
     src_dir: Path = paths.LIBXML2_SRC_DIR
+    cacheable: bool = True
+    # The host and Windows builds share src_dir, and may run at the same time.
+    _src_lock = threading.Lock()
 
     @contextlib.contextmanager
     def _backup_file(self, file_to_backup: Path) -> Iterator[None]:
@@ -773,9 +864,10 @@ class LibXml2Builder(base_builders.CMakeBuilder, base_builders.LibInfo):
         # so that they will not be used during our build.
         # We don't delete them here because the same libxml2 may be used to build
         # Android platform later.
-        with self._backup_file(self.src_dir / 'include' / 'libxml' / 'xmlversion.h'):
-            with self._backup_file(self.src_dir / 'config.h'):
-                super().build()
+        with self._src_lock:
+            with self._backup_file(self.src_dir / 'include' / 'libxml' / 'xmlversion.h'):
+                with self._backup_file(self.src_dir / 'config.h'):
+                    super().build()
 
     @property
     def ldflags(self) -> List[str]:
@@ -813,6 +905,8 @@ class LibXml2Builder(base_builders.CMakeBuilder, base_builders.LibInfo):
 class LldbServerBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'lldb-server'
     src_dir: Path = paths.LLVM_PATH / 'llvm'
+    depends_on: List[str] = ['device-sysroots', 'builtins', 'libunwind']
+    concurrent_configs: bool = True
     config_list: List[configs.Config] = configs.android_configs(platform=False, static=True)
     ninja_targets: List[str] = ['lldb-server']
 
@@ -864,19 +958,30 @@ class LldbServerBuilder(base_builders.LLVMRuntimeBuilder):
 class HostSysrootsBuilder(base_builders.Builder):
     name: str = 'host-sysroots'
     config_list: List[configs.Config] = (configs.MinGWConfig(),)
+    cacheable: bool = True
+
+    @property
+    def cache_artifacts(self) -> List[Path]:
+        return [self._config.sysroot]
+
+    @property
+    def _fingerprint_inputs(self) -> Dict[str, Any]:
+        inputs = super()._fingerprint_inputs
+        inputs['sources'] = [source_manager.source_fingerprint(self._config.gcc_root),
+                             source_manager.source_fingerprint(paths.WINDOWS_CLANG_PREBUILT_DIR)]
+        return inputs
 
     def _build_config(self) -> None:
         config = self._config
         sysroot = config.sysroot
         sysroot_lib = sysroot / 'lib'
-        if sysroot.exists():
-            shutil.rmtree(sysroot)
+        deletion_service.delete(sysroot)
         sysroot.parent.mkdir(parents=True, exist_ok=True)
 
         # copy sysroot and add libgcc* to it.
-        shutil.copytree(config.gcc_root / config.gcc_triple,
+        utils.copy_tree(config.gcc_root / config.gcc_triple,
                         sysroot, symlinks=True)
-        shutil.copytree(config.gcc_lib_dir, sysroot_lib, dirs_exist_ok=True)
+        utils.copy_tree(config.gcc_lib_dir, sysroot_lib, dirs_exist_ok=True)
 
         # b/237425904 cleanup: uncomment to remove libstdc++ after toolchain defaults to
         # libc++
@@ -886,26 +991,40 @@ class HostSysrootsBuilder(base_builders.Builder):
         # copy libc++ libs and headers from bootstrap prebuilts.  This is needed
         # for the libcxx builder to pass CMake configuration.  The libcxx
         # builder will subsequently overwrite these.
-        shutil.copy(paths.WINDOWS_CLANG_PREBUILT_DIR / 'lib' / 'libc++.a', sysroot_lib)
-        shutil.copy(paths.WINDOWS_CLANG_PREBUILT_DIR / 'lib' / 'libc++abi.a', sysroot_lib)
-        shutil.copytree(paths.WINDOWS_CLANG_PREBUILT_DIR / 'include' / 'c++' / 'v1',
+        utils.copy_file(paths.WINDOWS_CLANG_PREBUILT_DIR / 'lib' / 'libc++.a', sysroot_lib)
+        utils.copy_file(paths.WINDOWS_CLANG_PREBUILT_DIR / 'lib' / 'libc++abi.a', sysroot_lib)
+        utils.copy_tree(paths.WINDOWS_CLANG_PREBUILT_DIR / 'include' / 'c++' / 'v1',
                         sysroot / 'include' / 'c++' / 'v1')
 
 
 class DeviceSysrootsBuilder(base_builders.Builder):
     name: str = 'device-sysroots'
+    concurrent_configs: bool = True
+    cacheable: bool = True
     config_list: List[configs.Config] = (
         configs.android_configs(platform=True) +
         configs.android_configs(platform=False)
     )
 
+    @property
+    def cache_artifacts(self) -> List[Path]:
+        return [self._config.sysroot]
+
+    @property
+    def _fingerprint_inputs(self) -> Dict[str, Any]:
+        inputs = super()._fingerprint_inputs
+        if self._config.target_arch == hosts.Arch.RISCV64:
+            inputs['sources'] = source_manager.source_fingerprint(paths.RISCV64_ANDROID_SYSROOT)
+        else:
+            inputs['sources'] = source_manager.source_fingerprint(paths.NDK_BASE)
+        return inputs
+
     def _build_config(self) -> None:
         config: configs.AndroidConfig = cast(configs.AndroidConfig, self._config)
         arch = config.target_arch
         platform = config.platform
         sysroot = config.sysroot
-        if sysroot.exists():
-            shutil.rmtree(sysroot)
+        deletion_service.delete(sysroot)
         sysroot.mkdir(parents=True, exist_ok=True)
 
         # Copy the NDK prebuilt's sysroot, but for the platform variant, omit
@@ -916,7 +1035,7 @@ class DeviceSysrootsBuilder(base_builders.Builder):
             src_sysroot = paths.NDK_BASE / 'toolchains' / 'llvm' / 'prebuilt' / 'linux-x86_64' / 'sysroot'
 
         # Copy over usr/include.
-        shutil.copytree(src_sysroot / 'usr' / 'include',
+        utils.copy_tree(src_sysroot / 'usr' / 'include',
                         sysroot / 'usr' / 'include', symlinks=True)
 
         if platform:
@@ -925,13 +1044,13 @@ class DeviceSysrootsBuilder(base_builders.Builder):
                 shutil.rmtree(sysroot / 'usr' / 'include' / 'c++')
         else:
             # Add the android_support headers from usr/local/include.
-            shutil.copytree(src_sysroot / 'usr' / 'local' / 'include',
+            utils.copy_tree(src_sysroot / 'usr' / 'local' / 'include',
                             sysroot / 'usr' / 'local' / 'include', symlinks=True)
 
         # Copy over usr/lib/$TRIPLE.
         src_lib = src_sysroot / 'usr' / 'lib' / config.ndk_sysroot_triple
         dest_lib = sysroot / 'usr' / 'lib' / config.ndk_sysroot_triple
-        shutil.copytree(src_lib, dest_lib, symlinks=True)
+        utils.copy_tree(src_lib, dest_lib, symlinks=True)
 
         # Remove the NDK's libcompiler_rt-extras.  For the platform, also remove
         # the NDK libc++, except for the riscv64 sysroot which doesn't have
@@ -996,6 +1115,8 @@ class DeviceSysrootsBuilder(base_builders.Builder):
 class PlatformLibcxxAbiBuilder(base_builders.LLVMRuntimeBuilder):
     name = 'platform-libcxxabi'
     src_dir: Path = paths.LLVM_PATH / 'runtimes'
+    depends_on: List[str] = ['device-sysroots', 'builtins', 'libunwind']
+    concurrent_configs: bool = True
     config_list: List[configs.Config] = configs.android_configs(
         platform=True, suppress_libcxx_headers=True)
 
@@ -1077,9 +1198,9 @@ class LibCxxBuilder(base_builders.LLVMRuntimeBuilder):
         (sysroot / 'lib' / 'libc++abi.a').unlink()
         shutil.rmtree(sysroot / 'include' / 'c++' / 'v1')
 
-        shutil.copy(self.install_dir / 'lib' / 'libc++.a', sysroot / 'lib')
-        shutil.copy(self.install_dir / 'lib' / 'libc++abi.a', sysroot / 'lib')
-        shutil.copytree(self.install_dir / 'include' / 'c++' / 'v1',
+        utils.copy_file(self.install_dir / 'lib' / 'libc++.a', sysroot / 'lib')
+        utils.copy_file(self.install_dir / 'lib' / 'libc++abi.a', sysroot / 'lib')
+        utils.copy_tree(self.install_dir / 'include' / 'c++' / 'v1',
                         sysroot / 'include' / 'c++' / 'v1', dirs_exist_ok=True)
 
 
@@ -1186,13 +1307,18 @@ class WindowsToolchainBuilder(base_builders.LLVMBuilder):
 class TsanBuilder(base_builders.LLVMRuntimeBuilder):
     name: str = 'tsan'
     src_dir: Path = paths.LLVM_PATH / 'compiler-rt'
+    # Installs over the tsan libraries copied to runtimes_ndk_cxx by compiler-rt.
+    depends_on: List[str] = ['device-sysroots', 'builtins', 'libunwind', 'platform-libcxxabi',
+                             'compiler-rt']
+    concurrent_configs: bool = True
+    remote_buildable: bool = True
+    remote_source_dirs: List[Path] = CompilerRTBuilder.remote_source_dirs
     config_list: List[configs.Config] = configs.android_ndk_tsan_configs()
 
     @property
     def install_dir(self) -> Path:
         # Installs to a temporary dir and copies to runtimes_ndk_cxx manually.
-        output_dir = self.output_dir
-        return output_dir.parent / (output_dir.name + '-install')
+        return self.staging_install_dir
 
     @property
     def cmake_defines(self) -> Dict[str, str]:
@@ -1234,5 +1360,6 @@ class TsanBuilder(base_builders.LLVMRuntimeBuilder):
         # CMake builds other libraries (fuzzer, ubsan_standalone) etc.  Only
         # install tsan libraries.
         dst_dir.mkdir(exist_ok=True)
-        for tsan_lib in lib_dir.glob('*tsan*'):
-            shutil.copy(tsan_lib, dst_dir)
+        with utils.dir_lock(dst_dir):
+            for tsan_lib in lib_dir.glob('*tsan*'):
+                shutil.copy(tsan_lib, dst_dir)
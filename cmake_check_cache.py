@@ -0,0 +1,153 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Shares the results of CMake configure checks between builds with the same compiler and flags.
+
+check_c_compiler_flag(), check_include_file() and friends store their results
+as INTERNAL cache entries, and skip the try_compile if the entry is already
+defined. The results of one configure are collected into an initial cache
+file, which later configures with the same key load with cmake -C.
+
+Seeded checks don't run, so every VALIDATE_EVERY uses of a file, a configure
+runs all checks again. Checks whose results changed are then dropped.
+"""
+
+import logging
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Dict, NamedTuple, Optional, Set
+
+import paths
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+# Names of the cache entries that hold the result of a check, e.g. HAVE_UNISTD_H,
+# COMPILER_RT_HAS_FPIC_FLAG, LIBCXX_HAS_PTHREAD_LIB or CXX_SUPPORTS_NOSTDLIBXX_FLAG.
+_CHECK_NAME = re.compile(r'HAVE_\w+|\w+_HAS_\w+|\w*SUPPORTS_\w+')
+_CACHE_ENTRY = re.compile(r'(?P<name>\w+):INTERNAL=(?P<value>.*)')
+_INITIAL_CACHE_ENTRY = re.compile(r'set\((?P<name>\w+) "(?P<value>(?:[^"\\]|\\.)*)" CACHE INTERNAL ""\)')
+_DIFFERS = re.compile(r'# differs: (?P<name>\w+)')
+_USES = re.compile(r'# uses: (?P<uses>\d+)')
+
+"""Configures seeded from a file before a configure runs all checks to validate it."""
+VALIDATE_EVERY: int = 20
+
+_lock = threading.Lock()
+
+
+def cache_file(key: str) -> Path:
+    """Returns the initial cache file for key."""
+    return paths.OUT_DIR / 'cmake-check-cache' / f'{key}.cmake'
+
+
+def _escape(value: str) -> str:
+    return re.sub(r'([\\"$])', r'\\\1', value)
+
+
+def _unescape(value: str) -> str:
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+class _CacheFile(NamedTuple):
+    uses: int
+    differs: Set[str]
+    results: Dict[str, str]
+
+    @staticmethod
+    def read(path: Path) -> '_CacheFile':
+        text = path.read_text() if path.exists() else ''
+        uses = _USES.search(text)
+        return _CacheFile(int(uses['uses']) if uses else 0,
+                          {match['name'] for match in _DIFFERS.finditer(text)},
+                          {match['name']: _unescape(match['value'])
+                           for match in _INITIAL_CACHE_ENTRY.finditer(text)})
+
+    def write(self, path: Path) -> None:
+        text = f'# uses: {self.uses}\n'
+        text += ''.join(f'# differs: {name}\n' for name in sorted(self.differs))
+        text += ''.join(f'set({name} "{_escape(value)}" CACHE INTERNAL "")\n'
+                        for name, value in sorted(self.results.items()))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+        tmp_path.write_text(text)
+        os.replace(tmp_path, path)
+
+
+def _check_results(cmake_cache: Path) -> Dict[str, str]:
+    """Returns the check results in a CMakeCache.txt."""
+    try:
+        text = cmake_cache.read_text()
+    except FileNotFoundError:
+        return {}
+    results: Dict[str, str] = {}
+    for line in text.splitlines():
+        if (match := _CACHE_ENTRY.fullmatch(line)) and _CHECK_NAME.fullmatch(match['name']):
+            results[match['name']] = match['value']
+    return results
+
+
+def load(key: str) -> Optional[Path]:
+    """Returns the initial cache file to seed a configure with, if any.
+
+    Returns None if nothing was collected for key yet, or if it's time to
+    validate the file. The configure must then run all checks.
+    """
+    path = cache_file(key)
+    with _lock:
+        if not path.exists():
+            return None
+        cache = _CacheFile.read(path)
+        if cache.uses >= VALIDATE_EVERY:
+            logger().info('Validating %s: running all CMake checks', path.name)
+            return None
+        cache._replace(uses=cache.uses + 1).write(path)
+    return path
+
+
+def discard(key: str) -> None:
+    """Deletes the file for key, e.g. after a configure seeded from it failed."""
+    cache_file(key).unlink(missing_ok=True)
+
+
+def collect(key: str, build_dir: Path, seeded: bool) -> None:
+    """Adds the check results in the CMakeCache.txt of build_dir to the file for key.
+
+    If the configure wasn't seeded, it ran all checks, which validates the
+    file. Checks whose results differ between configures, e.g. after a
+    compiler change that the key misses, are dropped and run every time.
+    """
+    found = _check_results(build_dir / 'CMakeCache.txt')
+    if not found:
+        return
+    path = cache_file(key)
+    with _lock:
+        cache = _CacheFile.read(path)
+        results = dict(cache.results)
+        differs = set(cache.differs)
+        for name, value in found.items():
+            if name in differs or results.setdefault(name, value) == value:
+                continue
+            logger().info('Not sharing CMake check %s: results differ between configures', name)
+            differs.add(name)
+            del results[name]
+        updated = _CacheFile(cache.uses if seeded else 0, differs, results)
+        if updated != cache or not path.exists():
+            updated.write(path)
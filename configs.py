@@ -21,13 +21,16 @@ import functools
 import json
 
 import hosts
+import memoize
 import paths
 import toolchains
 import win_sdk
 
-class Config:
+class Config(memoize.Memoized):
     """Base configuration."""
 
+    memoized_properties = frozenset({'cflags', 'cxxflags', 'ldflags', 'env', 'cmake_defines'})
+
     name: str
     target_os: hosts.Host
     target_arch: hosts.Arch = hosts.Arch.AARCH64
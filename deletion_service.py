@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Deletes directory trees in the background."""
+
+import atexit
+from concurrent import futures
+import itertools
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+from typing import Callable, List, Optional, Set
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+_TRASH_NAME = re.compile(r'\..+\.deleting\.(?P<pid>\d+)\.\d+')
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DeletionService:
+    """Deletes directory trees without making the caller wait for the unlinks.
+
+    A tree is renamed aside first, so its path can be reused as soon as
+    delete() returns, and is then removed by a pool of threads.
+
+    Trees left behind by builds that were killed before their deletes
+    finished are removed the first time a tree in the same directory is
+    deleted, or when the directory is swept.
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                    thread_name_prefix='delete')
+        self._lock = threading.Lock()
+        self._pending: List[futures.Future] = []
+        self._counter = itertools.count()
+        self._swept: Set[Path] = set()
+
+    def _trash_path(self, path: Path) -> Path:
+        return path.parent / f'.{path.name}.deleting.{os.getpid()}.{next(self._counter)}'
+
+    @staticmethod
+    def _remove(path: Path, before: Optional[Callable[[Path], None]] = None) -> None:
+        def on_error(function, failed_path, excinfo) -> None:
+            logger().warning('Failed to delete %s: %s', failed_path, excinfo[1])
+        if before:
+            before(path)
+        shutil.rmtree(path, onerror=on_error)
+
+    def sweep(self, directory: Path) -> None:
+        """Deletes the trees in directory left behind by builds that aren't running anymore."""
+        directory = Path(directory)
+        with self._lock:
+            if directory in self._swept:
+                return
+            self._swept.add(directory)
+        try:
+            with os.scandir(directory) as it:
+                stale = [Path(entry.path) for entry in it
+                         if (match := _TRASH_NAME.fullmatch(entry.name))
+                         and int(match['pid']) != os.getpid()
+                         and not _is_running(int(match['pid']))]
+        except FileNotFoundError:
+            return
+        for trash in stale:
+            logger().info('Deleting %s, left behind by an earlier build', trash)
+            with self._lock:
+                self._pending.append(self._executor.submit(self._remove, trash))
+
+    def delete(self, path: Path, before: Optional[Callable[[Path], None]] = None) -> None:
+        """Deletes the tree at path, if it exists.
+
+        before is called with the path the tree was moved to, before it is
+        deleted.
+        """
+        path = Path(path)
+        if not path.exists() and not path.is_symlink():
+            return
+        if path.is_symlink() or not path.is_dir():
+            path.unlink()
+            return
+        self.sweep(path.parent)
+        with self._lock:
+            trash = self._trash_path(path)
+        try:
+            path.rename(trash)
+        except OSError as e:
+            # e.g. path is a mount point. Delete it in place.
+            logger().info('Deleting %s in place: %s', path, e)
+            if before:
+                before(path)
+            shutil.rmtree(path)
+            return
+        with self._lock:
+            self._pending = [future for future in self._pending if not future.done()]
+            self._pending.append(self._executor.submit(self._remove, trash, before))
+
+    def drain(self) -> None:
+        """Waits for all pending deletes."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            logger().info('Waiting for %d pending deletes', len(pending))
+            futures.wait(pending)
+
+
+_service = DeletionService()
+atexit.register(_service.drain)
+
+
+def delete(path: Path, before: Optional[Callable[[Path], None]] = None) -> None:
+    """Deletes the tree at path in the background. See DeletionService."""
+    _service.delete(path, before)
+
+
+def sweep(directory: Path) -> None:
+    """Deletes stale trees in directory in the background. See DeletionService."""
+    _service.sweep(directory)
+
+
+def drain() -> None:
+    """Waits for all pending deletes."""
+    _service.drain()
@@ -0,0 +1,149 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tracks the disk usage of build dirs, and deletes intermediate ones early."""
+
+import atexit
+from concurrent import futures
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+import deletion_service
+import paths
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+def measure(path: Path) -> int:
+    """Returns the bytes allocated to the tree at path, counting hard links once."""
+    seen: Set[Tuple[int, int]] = set()
+    total = 0
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_blocks * 512
+    return total
+
+
+class DiskUsage:
+    """Records the disk usage of build dirs once they are complete.
+
+    A build dir is released once no later step reads it. With eager_cleanup,
+    released dirs are deleted right away instead of at the end of the build,
+    which keeps the peak disk usage of OUT_DIR down.
+    """
+
+    def __init__(self, report_file: Path, eager_cleanup: bool) -> None:
+        self.report_file = report_file
+        self.eager_cleanup = eager_cleanup
+        self._lock = threading.Lock()
+        # Build dir -> (step, future of its size in bytes)
+        self._usage: Dict[Path, Tuple[str, futures.Future]] = {}
+        self._deleted: Set[Path] = set()
+        self._executor = futures.ThreadPoolExecutor(max_workers=1,
+                                                    thread_name_prefix='disk-usage')
+        self._min_free: Optional[int] = None
+        self._sample_free()
+
+    def _sample_free(self) -> None:
+        if not paths.OUT_DIR.exists():
+            return
+        free = shutil.disk_usage(paths.OUT_DIR).free
+        with self._lock:
+            if self._min_free is None or free < self._min_free:
+                self._min_free = free
+
+    def _measure(self, path: Path) -> int:
+        usage = measure(path)
+        self._sample_free()
+        return usage
+
+    def record(self, name: str, path: Path) -> None:
+        """Records the disk usage of the build dir path as name, in the background."""
+        if not path.is_dir():
+            return
+        with self._lock:
+            self._usage[path] = (name, self._executor.submit(self._measure, path))
+
+    def release(self, name: str, path: Path) -> None:
+        """Records the build dir path as name, and deletes it if eager_cleanup is set."""
+        if not self.eager_cleanup:
+            self.record(name, path)
+            return
+        if not path.is_dir():
+            return
+        measured: futures.Future = futures.Future()
+        with self._lock:
+            self._usage[path] = (name, measured)
+            self._deleted.add(path)
+        logger().info('Deleting %s: %s is no longer needed', path, name)
+        def before_delete(trash: Path) -> None:
+            measured.set_result(self._measure(trash))
+        deletion_service.delete(path, before=before_delete)
+
+    def report(self) -> str:
+        """Returns the recorded build dirs by size."""
+        deletion_service.drain()
+        with self._lock:
+            recorded = dict(self._usage)
+            deleted = set(self._deleted)
+        # Skip deleted dirs that the deletion service never got to measure.
+        usage = {path: (name, future.result()) for path, (name, future) in recorded.items()
+                 if future.done() or path not in deleted}
+        min_free = self._min_free
+        lines = ['Disk usage of build dirs (GiB, step, build dir):']
+        for path, (name, size) in sorted(usage.items(), key=lambda item: item[1][1],
+                                         reverse=True):
+            lines.append(f'  {size / 1024**3:7.2f} {name} {path}' +
+                         (' (deleted early)' if path in deleted else ''))
+        lines.append(f'Total: {sum(size for _, size in usage.values()) / 1024**3:.2f} GiB')
+        if min_free is not None:
+            lines.append(f'Least free space in OUT_DIR: {min_free / 1024**3:.2f} GiB')
+        return '\n'.join(lines)
+
+    def write_report(self) -> None:
+        """Writes the report to report_file."""
+        text = self.report()
+        logger().info('%s', text)
+        self.report_file.parent.mkdir(parents=True, exist_ok=True)
+        self.report_file.write_text(text + '\n')
+
+
+_usage: Optional[DiskUsage] = None
+
+
+def start(report_file: Path, eager_cleanup: bool) -> DiskUsage:
+    """Starts recording disk usage, and writes the report to report_file at exit."""
+    global _usage  # pylint: disable=global-statement
+    _usage = DiskUsage(report_file, eager_cleanup)
+    atexit.register(_usage.write_report)
+    return _usage
+
+
+def get() -> Optional[DiskUsage]:
+    """Returns the disk usage of this build, or None if it isn't tracked."""
+    return _usage
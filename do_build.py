@@ -17,25 +17,39 @@
 # pylint: disable=not-callable, line-too-long, no-else-return
 
 import argparse
+import functools
 import glob
+import json
 import logging
 from pathlib import Path
 import os
 import shutil
 import sys
 import textwrap
-from typing import List, NamedTuple, Optional, Set, Tuple
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 import re
 
 import android_version
+import artifact_cache
 from base_builders import Builder, LLVMBuilder
+import build_journal
+import build_plan
+import build_report
 import builders
 from builder_registry import BuilderRegistry
 import configs
+import deletion_service
+import disk_usage
 import hosts
+import jobserver
 import paths
+import pressure
+import remote_worker
+import scheduler
 import source_manager
+import thinlto_cache
 import timer
+import tmpfs
 import toolchains
 import utils
 from version import Version
@@ -57,21 +71,25 @@ class Profile(NamedTuple):
     ClangBoltProfile: Optional[Path]
 
 
-def extract_profiles() -> Profile:
+def extract_profiles(dry_run: bool = False) -> Profile:
+    """Extracts the profiles. With dry_run, returns where they would be extracted to."""
     pgo_profdata_tar = paths.pgo_profdata_tar()
     if not pgo_profdata_tar:
         return Profile(None, None)
-    utils.check_call(['tar', '-jxC', str(paths.OUT_DIR), '-f', str(pgo_profdata_tar)])
     profdata_file = paths.OUT_DIR / paths.pgo_profdata_filename()
+    bolt_fdata_tar = paths.bolt_fdata_tar()
+    clang_bolt_fdata_file = paths.OUT_DIR / 'clang.fdata'
+    if dry_run:
+        return Profile(profdata_file, clang_bolt_fdata_file if bolt_fdata_tar else None)
+
+    utils.check_call(['tar', '-jxC', str(paths.OUT_DIR), '-f', str(pgo_profdata_tar)])
     if not profdata_file.exists():
         logger().info('PGO profdata missing')
         return Profile(None, None)
 
-    bolt_fdata_tar = paths.bolt_fdata_tar()
     if not bolt_fdata_tar:
         return Profile(profdata_file, None)
     utils.check_call(['tar', '-jxC', str(paths.OUT_DIR), '-f', str(bolt_fdata_tar)])
-    clang_bolt_fdata_file = paths.OUT_DIR / 'clang.fdata'
     if not clang_bolt_fdata_file.exists():
         logger().info('Clang BOLT profile missing')
         return Profile(profdata_file, None)
@@ -82,29 +100,43 @@ def extract_profiles() -> Profile:
 def build_llvm_for_windows(enable_assertions: bool,
                            build_name: str,
                            build_lldb: bool,
-                           swig_builder: Optional[builders.SwigBuilder]):
+                           swig_builder: Optional[builders.SwigBuilder],
+                           toolchain: toolchains.Toolchain):
     config_list: List[configs.Config]
     if win_sdk.is_enabled():
         config_list = [configs.MSVCConfig()]
     else:
         config_list = [configs.MinGWConfig()]
 
-    win_builder = builders.WindowsToolchainBuilder(config_list)
-    if win_builder.install_dir.exists():
-        shutil.rmtree(win_builder.install_dir)
+    def with_toolchain(builder):
+        # The host build changes the default toolchains while this runs, so
+        # pin them to keep the compiler and fingerprints of each step stable.
+        builder.output_toolchain = toolchain
+        return builder
+
+    # Host sysroots are currently setup only for Windows
+    with_toolchain(builders.HostSysrootsBuilder(toolchain=toolchain)).build()
+
+    win_builder = with_toolchain(builders.WindowsToolchainBuilder(config_list, toolchain))
+    def remove_install_dir() -> None:
+        deletion_service.delete(win_builder.install_dir)
+    # libcxx installs to the same directory, so keep it when resuming after
+    # libcxx was built.
+    build_journal.get().run('windows_remove_install_dir',
+                            utils.fingerprint(str(win_builder.install_dir)), remove_install_dir)
 
     if not win_sdk.is_enabled():
         # Build and install libcxxabi and libcxx and use them to build Clang.
-        libcxx_builder = builders.LibCxxBuilder(config_list)
+        libcxx_builder = with_toolchain(builders.LibCxxBuilder(config_list, toolchain))
         libcxx_builder.enable_assertions = enable_assertions
         libcxx_builder.build()
 
-    libzstd_builder = builders.ZstdBuilder(config_list)
+    libzstd_builder = with_toolchain(builders.ZstdBuilder(config_list, toolchain))
     libzstd_builder.build()
     win_builder.libzstd = libzstd_builder
 
     lldb_bins: Set[str] = set()
-    libxml2_builder = builders.LibXml2Builder(config_list)
+    libxml2_builder = with_toolchain(builders.LibXml2Builder(config_list, toolchain))
     libxml2_builder.build()
     win_builder.libxml2 = libxml2_builder
     for lib in libxml2_builder.install_libraries:
@@ -116,7 +148,7 @@ def build_llvm_for_windows(enable_assertions: bool,
         win_builder.libedit = None
         win_builder.swig_executable = swig_builder.install_dir / 'bin' / 'swig'
 
-        xz_builder = builders.XzBuilder(config_list)
+        xz_builder = with_toolchain(builders.XzBuilder(config_list, toolchain))
         xz_builder.build()
         win_builder.liblzma = xz_builder
 
@@ -182,22 +214,64 @@ def build_runtimes(build_lldb_server: bool,
                    stage: str,
                    host_config: configs.Config,
                    host_32bit_config: configs.Config):
-    builders.DeviceSysrootsBuilder().build()
-    builders.BuiltinsBuilder().build()
-    builders.LibUnwindBuilder().build()
-    builders.PlatformLibcxxAbiBuilder().build()
-    builders.CompilerRTBuilder().build()
-    builders.TsanBuilder().build()
+    # Builders are added in the order they used to run serially.  Independent
+    # ones run concurrently when --builder-jobs is larger than 1.
+    runtimes = scheduler.Scheduler()
+    runtimes.add_builder(builders.DeviceSysrootsBuilder())
+    runtimes.add_builder(builders.BuiltinsBuilder())
+    runtimes.add_builder(builders.LibUnwindBuilder())
+    runtimes.add_builder(builders.PlatformLibcxxAbiBuilder())
+    runtimes.add_builder(builders.CompilerRTBuilder())
+    runtimes.add_builder(builders.TsanBuilder())
     # Build musl runtimes and 32-bit glibc for Linux
     if hosts.build_host().is_linux:
-        add_lib_links(stage, host_config)
-        add_lib_links(stage, host_32bit_config)
-        add_header_links(stage, host_config)
-        builders.MuslHostRuntimeBuilder().build()
-    builders.LibOMPBuilder().build()
+        def add_host_links() -> None:
+            add_lib_links(stage, host_config)
+            add_lib_links(stage, host_32bit_config)
+            add_header_links(stage, host_config)
+        runtimes.add('host-lib-links', add_host_links)
+        musl_host_builder = builders.MuslHostRuntimeBuilder()
+        runtimes.add_builder(musl_host_builder,
+                             deps=musl_host_builder.depends_on + ['host-lib-links'])
+    runtimes.add_builder(builders.LibOMPBuilder())
     if build_lldb_server:
-        builders.LldbServerBuilder().build()
-    builders.SanitizerMapFileBuilder().build()
+        runtimes.add_builder(builders.LldbServerBuilder())
+    runtimes.add_builder(builders.SanitizerMapFileBuilder())
+    runtimes.run()
+
+
+def _regular_files(root: Path) -> Dict[str, Tuple[int, int]]:
+    """Returns the mtime and size of the regular files under root."""
+    files: Dict[str, Tuple[int, int]] = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            if not path.is_symlink():
+                stat = path.stat()
+                files[str(path.relative_to(root))] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def save_runtimes_snapshot(toolchain_builder: LLVMBuilder, snapshot_file: Path) -> None:
+    """Records the files of a toolchain before build_runtimes installs into it."""
+    with snapshot_file.open('w') as outfile:
+        json.dump(_regular_files(toolchain_builder.install_dir), outfile)
+
+
+def copy_runtimes(src_builder: LLVMBuilder, dst_builder: LLVMBuilder,
+                  snapshot_file: Path) -> None:
+    """Copies the runtimes installed into src_builder since the snapshot to dst_builder.
+
+    Symlinks are skipped: the host lib links point to triple specific
+    directories, so they are created for each toolchain instead.
+    """
+    with snapshot_file.open() as infile:
+        before = {path: tuple(stat) for path, stat in json.load(infile).items()}
+    src, dst = src_builder.install_dir, dst_builder.install_dir
+    for path, stat in _regular_files(src).items():
+        if before.get(path) != stat:
+            (dst / path).parent.mkdir(parents=True, exist_ok=True)
+            utils.copy_file(src / path, dst / path)
 
 
 def install_wrappers(llvm_install_path: Path, llvm_next=False) -> None:
@@ -424,7 +498,7 @@ def bolt_instrument(toolchain_builder: LLVMBuilder):
 
 def package_toolchain(toolchain_builder: LLVMBuilder,
                       necessary_bin_files: Optional[Set[str]]=None,
-                      strip=True, create_tar=True, llvm_next=False):
+                      strip=True, llvm_next=False):
     dist_dir = Path(utils.ORIG_ENV.get('DIST_DIR', paths.OUT_DIR))
     build_dir = toolchain_builder.install_dir
     host_config = toolchain_builder.config_list[0]
@@ -434,16 +508,18 @@ def package_toolchain(toolchain_builder: LLVMBuilder,
 
     package_name = 'clang-' + build_name
 
-    install_dir = paths.get_package_install_path(host, package_name)
+    is_musl = isinstance(host_config, configs.LinuxMuslConfig)
+    install_dir = paths.get_package_install_path(host, package_name, is_musl)
     install_host_dir = install_dir.parent
 
     # Remove any previously installed toolchain so it doesn't pollute the
     # build.
-    if install_host_dir.exists():
-        shutil.rmtree(install_host_dir)
+    deletion_service.delete(install_host_dir)
 
-    # First copy over the entire set of output objects.
-    shutil.copytree(build_dir, install_dir, symlinks=True)
+    # First copy over the entire set of output objects. Files of the copy are
+    # only replaced or removed below, never written in place, so hard links
+    # are safe.
+    utils.copy_tree(build_dir, install_dir, symlinks=True, hardlink=True)
 
     ext = '.exe' if host.is_windows else ''
     script_ext = '.cmd' if host.is_windows else '.sh'
@@ -606,12 +682,13 @@ def package_toolchain(toolchain_builder: LLVMBuilder,
     libc_include_path = paths.ANDROID_DIR / 'bionic' / 'libc' / 'include'
     header_path = lib_dir / 'clang' / version.major_version() / 'include'
 
-    shutil.copy2(libc_include_path / 'stdatomic.h', header_path)
+    # Replaces clang's stdatomic.h, which may be a hard link into build_dir.
+    utils.copy_file(libc_include_path / 'stdatomic.h', header_path)
 
     bits_install_path = header_path / 'bits'
     bits_install_path.mkdir(parents=True, exist_ok=True)
     bits_stdatomic_path = libc_include_path / 'bits' / 'stdatomic.h'
-    shutil.copy2(bits_stdatomic_path, bits_install_path)
+    utils.copy_file(bits_stdatomic_path, bits_install_path)
 
     # Install license files as NOTICE in the toolchain install dir.
     install_license_files(install_dir)
@@ -692,16 +769,21 @@ def package_toolchain(toolchain_builder: LLVMBuilder,
                            )
             inputs_file.write(dependencies)
 
-    # Package up the resulting trimmed install/ directory.
-    if create_tar:
-        tag = host.os_tag
-        if isinstance(toolchain_builder.config_list[0], configs.LinuxMuslConfig):
-            tag = host.os_tag_musl
-        tarball_name = package_name + '-' + tag + '.tar.bz2'
-        package_path = dist_dir / tarball_name
-        logger().info(f'Packaging {package_path}')
-        args = ['tar', '-cjC', install_host_dir, '-f', package_path, package_name]
-        utils.check_call(args)
+
+def package_tarball(toolchain_builder: LLVMBuilder):
+    """Packages up the trimmed install/ directory from package_toolchain."""
+    dist_dir = Path(utils.ORIG_ENV.get('DIST_DIR', paths.OUT_DIR))
+    host = toolchain_builder.config_list[0].target_os
+    package_name = 'clang-' + toolchain_builder.build_name
+    is_musl = isinstance(toolchain_builder.config_list[0], configs.LinuxMuslConfig)
+    install_host_dir = paths.get_package_install_path(host, package_name, is_musl).parent
+
+    tag = host.os_tag_musl if is_musl else host.os_tag
+    tarball_name = package_name + '-' + tag + '.tar.bz2'
+    package_path = dist_dir / tarball_name
+    logger().info(f'Packaging {package_path}')
+    args = ['tar', '-cjC', install_host_dir, '-f', package_path, package_name]
+    utils.check_call(args)
 
 
 def parse_args():
@@ -903,6 +985,12 @@ def parse_args():
         default=True,
         dest='musl',
         help="Don't Build against musl libc")
+    musl_group.add_argument(
+        '--glibc-and-musl',
+        action='store_true',
+        default=False,
+        help='Build both the glibc and the musl Linux toolchains, from one stage1, with '
+        'shared device runtimes')
 
     parser.add_argument(
         '--sccache',
@@ -910,13 +998,182 @@ def parse_args():
         default=False,
         help='Use sccache to speed up development builds. (Do not use for release builds)')
 
+    parser.add_argument(
+        '--builder-jobs',
+        type=int,
+        default=1,
+        help='Number of independent builders (e.g. runtimes) to run concurrently.')
+
+    parser.add_argument(
+        '--config-jobs',
+        type=int,
+        default=1,
+        help='Number of configs to build concurrently, for builders whose configs are '
+        'independent (e.g. compiler-rt, libomp).')
+
+    parser.add_argument(
+        '--prebuilt-host-deps',
+        action='store_true',
+        default=False,
+        help='Build the host libraries used by stage2 (zstd, libxml2, xz, libedit) and swig '
+        'with the prebuilt toolchain, while stage1 builds, instead of with stage1.')
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=0,
+        help='Share JOBS tokens among all make and ninja invocations using a GNU make '
+        'jobserver (needs make >= 4.4 and ninja >= 1.13). By default each invocation '
+        'picks its own parallelism.')
+
+    parser.add_argument(
+        '--adaptive-jobs',
+        action='store_true',
+        default=False,
+        help='Hand out fewer jobserver tokens while /proc/pressure or the loadavg show '
+        'that the host is stalled, e.g. by other tenants, and more once it is calm '
+        'again. Starts the jobserver with one token per core if --jobs is not set.')
+
+    parser.add_argument(
+        '--tmpfs-dir',
+        type=Path,
+        help='Put the build dirs of --tmpfs-builders on this tmpfs. They are removed once '
+        'their outputs are installed.')
+
+    parser.add_argument(
+        '--tmpfs-builders',
+        default='builtins,libunwind,libomp,tsan,platform-libcxxabi',
+        help='Comma-separated builders to build on --tmpfs-dir.')
+
+    parser.add_argument(
+        '--tmpfs-min-free',
+        type=int,
+        default=4,
+        help='Build in OUT_DIR instead of --tmpfs-dir when it has less than this many GiB '
+        'free.')
+
+    parser.add_argument(
+        '--eager-cleanup',
+        action='store_true',
+        default=False,
+        help='Delete build dirs as soon as no later step needs them, e.g. runtime build '
+        'dirs once installed and the stage1 build dir once stage2 is built.')
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Skip the steps completed by the previous build with the same inputs, up to '
+        'the first step that must run again.')
+
+    parser.add_argument(
+        '--artifact-cache',
+        type=Path,
+        help='Directory to cache the outputs of cacheable builders (e.g. stage1, host '
+        'libraries, sysroots) in, keyed by a hash of their inputs.')
+
+    parser.add_argument(
+        '--artifact-cache-size',
+        type=int,
+        default=100,
+        help='Size limit of --artifact-cache in GiB. Least recently used outputs are '
+        'evicted first.')
+
+    parser.add_argument(
+        '--thinlto-cache',
+        type=Path,
+        help='Directory to keep the ThinLTO cache of --lto builds of stage2 in, so later '
+        'builds only redo the codegen of changed modules. Defaults to '
+        '$OUT_DIR/thinlto-cache.')
+
+    parser.add_argument(
+        '--thinlto-cache-size',
+        type=int,
+        default=20,
+        help='Size limit of --thinlto-cache in GiB. Least recently used entries are '
+        'pruned first.')
+
+    parser.add_argument(
+        '--remote-cache',
+        metavar='URL',
+        help='Share the artifact cache with other machines through an HTTP server '
+        '(see artifact_cache_server.py). Uses $OUT_DIR/artifact-cache as the local '
+        'cache if --artifact-cache is not set.')
+
+    worker_group = parser.add_mutually_exclusive_group()
+    worker_group.add_argument(
+        '--remote-workers',
+        metavar='HOST:PORT[,HOST:PORT...]',
+        help='Build the configs of the compiler-rt, libomp and tsan runtimes on workers '
+        'running remote_worker.py, with the key in $' + remote_worker.AUTHKEY_ENV +
+        '. Use --config-jobs to build enough configs at once to keep them busy.')
+    worker_group.add_argument(
+        '--local-workers',
+        type=int,
+        help='Like --remote-workers, with this many worker processes on this host, each '
+        'with an OUT_DIR in $OUT_DIR/workers.')
+
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        default=False,
+        help='Print the steps that would run, with the ETA and the critical path based on '
+        'earlier build times, without building anything.')
+
+    parser.add_argument(
+        '--plan-times',
+        type=Path,
+        action='append',
+        help='build_times.txt of an earlier build, for --plan. Can be repeated to use the '
+        'median of several builds. Defaults to $DIST_DIR/build_times.txt.')
+
     return parser.parse_args()
 
 
 def main():
     dist_dir = Path(utils.ORIG_ENV.get('DIST_DIR', paths.OUT_DIR))
     args = parse_args()
-    timer.Timer.register_atexit(dist_dir / 'build_times.txt')
+    scheduler.Scheduler.default_jobs = args.builder_jobs
+    Builder.config_jobs = args.config_jobs
+    if args.plan:
+        # Leave the build times, journal and caches of the last build alone.
+        plan = build_plan.start(build_plan.load_times(
+            args.plan_times or [dist_dir / 'build_times.txt']))
+        journal = build_journal.get()
+    else:
+        timer.Timer.register_atexit(dist_dir / 'build_times.txt')
+        build_report.register_atexit(dist_dir)
+        journal = build_journal.start(paths.OUT_DIR / 'build_journal.json', args.resume)
+        # Most build and install dirs are deleted from OUT_DIR. Deleting a
+        # tree sweeps the stale ones next to it too.
+        deletion_service.sweep(paths.OUT_DIR)
+    if (args.jobs or args.adaptive_jobs) and not args.plan:
+        server = jobserver.start(args.jobs or os.cpu_count() or 1)
+        if args.adaptive_jobs:
+            pressure.start(server)
+    if args.tmpfs_dir and not args.plan:
+        tmpfs.start(args.tmpfs_dir.resolve(), args.tmpfs_builders.split(','),
+                    args.tmpfs_min_free * 1024**3)
+    if not args.plan:
+        disk_usage.start(dist_dir / 'disk_usage.txt', args.eager_cleanup)
+    if args.remote_workers and not args.plan:
+        authkey = os.environ.get(remote_worker.AUTHKEY_ENV)
+        if not authkey:
+            raise RuntimeError(f'--remote-workers needs ${remote_worker.AUTHKEY_ENV}')
+        addresses = [(host, int(port)) for host, port in
+                     (worker.rsplit(':', 1) for worker in args.remote_workers.split(','))]
+        remote_worker.start(remote_worker.WorkerPool(addresses, authkey.encode()))
+    elif args.local_workers and not args.plan:
+        remote_worker.start(remote_worker.LocalWorkerPool(args.local_workers))
+    if (args.artifact_cache or args.remote_cache) and not args.plan:
+        remote = artifact_cache.HttpBackend(args.remote_cache) if args.remote_cache else None
+        cache_dir = args.artifact_cache or paths.OUT_DIR / 'artifact-cache'
+        artifact_cache.start(cache_dir.resolve(), args.artifact_cache_size * 1024**3,
+                             dist_dir / 'artifact_cache.txt', remote)
+    if args.lto and not args.plan:
+        cache_dir = args.thinlto_cache or paths.OUT_DIR / 'thinlto-cache'
+        thinlto_cache.start(cache_dir.resolve(), args.thinlto_cache_size * 1024**3,
+                            dist_dir / 'thinlto_cache.txt')
 
     if args.skip_build:
         # Skips all builds
@@ -945,6 +1202,8 @@ def main():
 
     need_host = hosts.build_host().is_darwin or ('linux' not in args.no_build)
     need_windows = hosts.build_host().is_linux and ('windows' not in args.no_build)
+    if args.glibc_and_musl and not hosts.build_host().is_linux:
+        raise RuntimeError('--glibc-and-musl is only supported on Linux')
 
     logging.basicConfig(level=logging.DEBUG)
 
@@ -953,8 +1212,13 @@ def main():
                   do_runtimes, do_package, need_windows, args.lto, args.bolt, args.musl))
 
     # Clone sources to be built and apply patches.
+    source_manager.set_llvm_source_options(args.llvm_rev, args.skip_apply_patches)
     if not args.skip_source_setup:
-        source_manager.setup_sources(llvm_rev=args.llvm_rev, skip_apply_patches=args.skip_apply_patches)
+        journal.run('setup_sources',
+                    lambda: source_manager.llvm_source_fingerprint(args.llvm_rev,
+                                                                   args.skip_apply_patches),
+                    lambda: source_manager.setup_sources(llvm_rev=args.llvm_rev,
+                                                         skip_apply_patches=args.skip_apply_patches))
 
     # Build the stage1 Clang for the build host
     instrumented = hosts.build_host().is_linux and args.build_instrumented
@@ -968,30 +1232,49 @@ def main():
     stage1.build_extra_tools = args.run_tests_stage1
     stage1.build_android_targets = args.debug or instrumented
     stage1.use_sccache = sccache
-    stage1.build()
-    if hosts.build_host().is_linux and not args.single_stage:
-        add_header_links('stage1', host_config=configs.host_config(musl))
-    # stage1 test is off by default, turned on by --run-tests-stage1,
-    # and suppressed by --skip-tests.
-    if not args.skip_tests and args.run_tests_stage1:
-        stage1.test()
-    if not args.single_stage:
-        set_default_toolchain(stage1.installed_toolchain)
+    if args.glibc_and_musl:
+        # stage1 needs the musl runtimes to build the musl stage2.
+        stage1.extra_runtime_configs = [configs.host_config(musl=True)]
+
+    def build_stage1():
+        stage1.build()
+        if hosts.build_host().is_linux and not args.single_stage:
+            journal.run('stage1_header_links', '',
+                        lambda: add_header_links('stage1', host_config=configs.host_config(musl)))
+        # stage1 test is off by default, turned on by --run-tests-stage1,
+        # and suppressed by --skip-tests.
+        if not args.skip_tests and args.run_tests_stage1:
+            journal.run('stage1_test', lambda: stage1.fingerprint, stage1.test)
+        if not args.single_stage:
+            set_default_toolchain(stage1.installed_toolchain)
+
+    # The host dependencies are small and independent of each other, and their
+    # configure steps are mostly serial, so the ones of each stage2 run at once,
+    # and each stage2 only waits for its own. With --prebuilt-host-deps they
+    # don't wait for stage1 either.
+    if args.prebuilt_host_deps:
+        host_deps_toolchain: Optional[toolchains.Toolchain] = toolchains.get_prebuilt_toolchain()
+        host_deps_after: List[str] = []
+    else:
+        host_deps_toolchain = None
+        host_deps_after = ['stage1']
+    # The host dependencies of each stage2, by stage2 name.
+    host_deps: Dict[str, scheduler.Scheduler] = {}
 
     if build_lldb:
         # Swig is needed for both host and windows lldb.
-        swig_builder = builders.SwigBuilder(host_configs)
-        swig_builder.build()
+        swig_builder = builders.SwigBuilder(host_configs, host_deps_toolchain)
     else:
         swig_builder = None
 
-    if need_host:
-        if args.pgo:
-            profdata, clang_bolt_fdata = extract_profiles()
-        else:
-            profdata, clang_bolt_fdata = None, None
-
-        stage2 = builders.Stage2Builder(host_configs)
+    def configure_stage2(host_config: configs.Config, suffix: str) -> builders.Stage2Builder:
+        """Returns a stage2 builder for host_config, and adds its libraries to host_deps."""
+        config_list = [host_config]
+        stage2 = builders.Stage2Builder(config_list)
+        if suffix:
+            BuilderRegistry.add_variant(stage2.name + suffix, stage2.name)
+            stage2.name += suffix
+        stage2.install_dir = paths.OUT_DIR / f'{stage2.name}-install'
         stage2.build_name = args.build_name
         stage2.svn_revision = android_version.get_svn_revision()
         stage2.debug_build = args.debug
@@ -1003,29 +1286,34 @@ def main():
         stage2.bolt_instrument = args.bolt_instrument
         stage2.profdata_file = profdata if profdata else None
         stage2.build_32bit_runtimes = hosts.build_host().is_linux
+        stage2_host_deps = host_deps[stage2.name] = scheduler.Scheduler()
 
-        libzstd_builder = builders.ZstdBuilder(host_configs)
-        libzstd_builder.build()
+        libzstd_builder = builders.ZstdBuilder(config_list, host_deps_toolchain)
+        libzstd_builder.step_suffix = suffix
+        stage2_host_deps.add_builder(libzstd_builder, name=libzstd_builder.name + suffix)
         stage2.libzstd = libzstd_builder
 
-        libxml2_builder = builders.LibXml2Builder(host_configs)
-        libxml2_builder.build()
+        libxml2_builder = builders.LibXml2Builder(config_list, host_deps_toolchain)
+        libxml2_builder.step_suffix = suffix
+        stage2_host_deps.add_builder(libxml2_builder, name=libxml2_builder.name + suffix)
         stage2.libxml2 = libxml2_builder
 
         stage2.build_lldb = build_lldb
         if build_lldb:
             stage2.swig_executable = swig_builder.install_dir / 'bin' / 'swig'
 
-            xz_builder = builders.XzBuilder(host_configs)
-            xz_builder.build()
+            xz_builder = builders.XzBuilder(config_list, host_deps_toolchain)
+            xz_builder.step_suffix = suffix
+            stage2_host_deps.add_builder(xz_builder, name=xz_builder.name + suffix)
             stage2.liblzma = xz_builder
             #
             # libncurses = builders.LibNcursesBuilder(host_configs)
             # libncurses.build()
             # stage2.libncurses = libncurses
 
-            libedit_builder = builders.LibEditBuilder(host_configs)
-            libedit_builder.build()
+            libedit_builder = builders.LibEditBuilder(config_list, host_deps_toolchain)
+            libedit_builder.step_suffix = suffix
+            stage2_host_deps.add_builder(libedit_builder, name=libedit_builder.name + suffix)
             stage2.libedit = libedit_builder
 
         stage2_tags = []
@@ -1038,63 +1326,178 @@ def main():
         if args.build_llvm_next:
             stage2_tags.append('ANDROID_LLVM_NEXT')
         stage2.build_tags = stage2_tags
+        return stage2
 
+    # With --glibc-and-musl, the musl toolchain is built next to the glibc one,
+    # by the same stage1, and shares its device runtimes.
+    stage2s: List[builders.Stage2Builder] = []
+    if need_host:
+        if args.pgo:
+            profdata, clang_bolt_fdata = extract_profiles(dry_run=args.plan)
+        else:
+            profdata, clang_bolt_fdata = None, None
+
+        stage2 = configure_stage2(configs.host_config(musl), '')
+        stage2s.append(stage2)
+        if args.glibc_and_musl:
+            stage2s.append(configure_stage2(configs.host_config(musl=True), '-musl'))
+        for host_stage2 in stage2s:
+            host_stage2.concurrent_builds = len(stage2s)
+    runtimes_snapshot = paths.OUT_DIR / 'stage2-runtimes-snapshot.json'
+
+    def build_stage2(stage2: builders.Stage2Builder):
         stage2.build()
 
+        # BOLT profiles are collected on the primary toolchain.
+        if stage2 is not stage2s[0]:
+            return
+
         if do_bolt and clang_bolt_fdata is not None:
-            bolt_optimize(stage2, clang_bolt_fdata)
+            journal.run('bolt_optimize', utils.fingerprint(str(clang_bolt_fdata)),
+                        lambda: bolt_optimize(stage2, clang_bolt_fdata))
 
         if not (stage2.build_instrumented or stage2.debug_build):
             set_default_toolchain(stage2.installed_toolchain)
 
         Builder.output_toolchain = stage2.installed_toolchain
-        if hosts.build_host().is_linux and do_runtimes:
-            build_runtimes(build_lldb_server=build_lldb,
-                           stage='stage2',
-                           host_config=configs.host_config(musl),
-                           host_32bit_config=configs.host_32bit_config(musl))
 
-    if need_windows:
-        # Host sysroots are currently setup only for Windows
-        builders.HostSysrootsBuilder().build()
-        if args.windows_sdk:
-            win_sdk.set_path(Path(args.windows_sdk))
+    # The Windows toolchain is built by stage1, next to stage2.
+    windows_toolchain = Builder.toolchain if args.single_stage else stage1.installed_toolchain
+    win_builder: Optional[LLVMBuilder] = None
+    win_lldb_bins: Set[str] = set()
+    if need_windows and args.windows_sdk:
+        win_sdk.set_path(Path(args.windows_sdk))
+
+    def build_windows():
+        nonlocal win_builder, win_lldb_bins
         win_builder, win_lldb_bins = build_llvm_for_windows(
             enable_assertions=args.enable_assertions,
             build_name=args.build_name,
             build_lldb=build_lldb,
-            swig_builder=swig_builder)
+            swig_builder=swig_builder,
+            toolchain=windows_toolchain)
+
+    def build_host_runtimes():
+        if len(stage2s) > 1:
+            journal.run('stage2_runtimes_snapshot', '',
+                        lambda: save_runtimes_snapshot(stage2, runtimes_snapshot))
+        build_runtimes(build_lldb_server=build_lldb,
+                       stage='stage2',
+                       host_config=configs.host_config(musl),
+                       host_32bit_config=configs.host_32bit_config(musl))
+
+    def install_shared_runtimes(stage2_musl: builders.Stage2Builder):
+        copy_runtimes(stage2, stage2_musl, runtimes_snapshot)
+        musl_config = stage2_musl.config_list[0]
+        add_lib_links(stage2_musl.name, musl_config)
+        add_lib_links(stage2_musl.name, configs.host_32bit_config(musl=True))
+        add_header_links(stage2_musl.name, musl_config)
 
     # stage2 test is on when stage2 is enabled unless --skip-tests or
     # on instrumented builds.
     need_tests = not args.skip_tests and need_host and \
             BuilderRegistry.should_build('stage2') and \
             (not args.build_instrumented)
+    # http://b/197645198 Temporarily skip tests on [Darwin] builds
+    if hosts.build_host().is_darwin:
+        need_tests = False
+
+    packages: List[LLVMBuilder] = []
+
+    def package():
+        # Instrument with llvm-bolt. Must be the last build step to prevent other
+        # build steps generating BOLT profiles.
+        if need_host:
+            if do_bolt_instrument:
+                journal.run('bolt_instrument', lambda: stage2.fingerprint,
+                            lambda: bolt_instrument(stage2))
+
+        if do_package and need_host:
+            for host_stage2 in stage2s:
+                journal.run('package_' + host_stage2.name,
+                            utils.fingerprint([do_strip_host_package, args.build_llvm_next]),
+                            lambda host_stage2=host_stage2: package_toolchain(
+                                host_stage2,
+                                strip=do_strip_host_package,
+                                llvm_next=args.build_llvm_next))
+                packages.append(host_stage2)
+
+        if do_package and need_windows:
+            journal.run('package_' + win_builder.name,
+                        utils.fingerprint([sorted(win_lldb_bins), do_strip]),
+                        lambda: package_toolchain(
+                            win_builder,
+                            necessary_bin_files=win_lldb_bins,
+                            strip=do_strip))
+            packages.append(win_builder)
+
+    # The Windows build only needs stage1, and the tests only use the stage2
+    # build directory, so they run next to the host build. Use --jobs to share
+    # the cores between them; lit gets half of them. The host deps of the musl
+    # stage2 may run next to those of the glibc one.
+    pipeline = scheduler.Scheduler(max_jobs=2 * len(stage2s) + 1)
+    pipeline.add('stage1', build_stage1, records_steps=True)
+    if swig_builder:
+        pipeline.add_builder(swig_builder, deps=host_deps_after)
+    for host_stage2 in stage2s:
+        stage2_host_deps = host_deps[host_stage2.name]
+        host_deps_task = 'host-deps' + host_stage2.name[len('stage2'):]
+        if stage2_host_deps.tasks:
+            stage2_host_deps.max_jobs = len(stage2_host_deps.tasks)
+            pipeline.add(host_deps_task, stage2_host_deps.run, deps=host_deps_after,
+                         records_steps=True)
+        pipeline.add(host_stage2.name, functools.partial(build_stage2, host_stage2),
+                     deps=['stage1', host_deps_task, 'swig'], records_steps=True)
+    if need_windows:
+        pipeline.add('windows', build_windows, deps=['stage1', 'swig'], records_steps=True)
     if need_tests:
-        # http://b/197645198 Temporarily skip tests on [Darwin] builds
-        if not (hosts.build_host().is_darwin):
-            stage2.test()
-
-    # Instrument with llvm-bolt. Must be the last build step to prevent other
-    # build steps generating BOLT profiles.
-    if need_host:
-        if do_bolt_instrument:
-            bolt_instrument(stage2)
-
-    if do_package and need_host:
-        package_toolchain(
-            stage2,
-            strip=do_strip_host_package,
-            create_tar=args.create_tar,
-            llvm_next=args.build_llvm_next)
-
-    if do_package and need_windows:
-        package_toolchain(
-            win_builder,
-            necessary_bin_files=win_lldb_bins,
-            strip=do_strip,
-            create_tar=args.create_tar)
-
+        for host_stage2 in stage2s:
+            host_stage2.test_jobs = max(1, (args.jobs or os.cpu_count() or 2) // 2 // len(stage2s))
+            pipeline.add(f'{host_stage2.name}_test',
+                         functools.partial(journal.run, f'{host_stage2.name}_test',
+                                           lambda host_stage2=host_stage2: host_stage2.fingerprint,
+                                           host_stage2.test),
+                         deps=[host_stage2.name])
+    if need_host and hosts.build_host().is_linux and do_runtimes:
+        pipeline.add('runtimes', build_host_runtimes, deps=['stage2'], records_steps=True)
+        for host_stage2 in stage2s[1:]:
+            pipeline.add(f'{host_stage2.name}_runtimes',
+                         functools.partial(journal.run, f'{host_stage2.name}_runtimes', '',
+                                           functools.partial(install_shared_runtimes,
+                                                             host_stage2)),
+                         deps=['runtimes', host_stage2.name], records_steps=True)
+    # Later builds and tests read the build dirs of stage1 and stage2, e.g. for
+    # their tablegen binaries, so they are released once those are done. With
+    # --debug or --build-instrumented, runtimes are built with stage1.
+    if usage := disk_usage.get():
+        if BuilderRegistry.should_build('stage1'):
+            pipeline.add('stage1_cleanup',
+                         functools.partial(usage.release, stage1.name, stage1.output_dir),
+                         deps=['stage1', 'windows', 'runtimes'] +
+                         [task for host_stage2 in stage2s
+                          for task in (host_stage2.name, f'{host_stage2.name}_runtimes')])
+        if BuilderRegistry.should_build('stage2'):
+            for host_stage2 in stage2s:
+                pipeline.add(f'{host_stage2.name}_cleanup',
+                             functools.partial(usage.release, host_stage2.name,
+                                               host_stage2.output_dir),
+                             deps=[host_stage2.name, f'{host_stage2.name}_test', 'runtimes',
+                                   f'{host_stage2.name}_runtimes'])
+    pipeline.add('package', package,
+                 deps=[task.name for task in pipeline.tasks
+                       if not task.name.endswith(('_test', '_cleanup'))],
+                 records_steps=True)
+    # Raises any failure once the packages are ready, before they are published.
+    pipeline.run()
+
+    if args.create_tar:
+        for toolchain_builder in packages:
+            journal.run(f'package_{toolchain_builder.name}_tar', '',
+                        lambda toolchain_builder=toolchain_builder:
+                            package_tarball(toolchain_builder))
+
+    if args.plan:
+        print(plan.report())
     return 0
 
 
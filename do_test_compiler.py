@@ -25,6 +25,7 @@ import shutil
 import subprocess
 from typing import Dict, List, Optional
 
+import deletion_service
 import hosts
 import paths
 import utils
@@ -357,8 +358,7 @@ def extract_packaged_clang(package_path: Path) -> Path:
 
     # Extract package to $OUT_DIR/extracted
     extract_dir = paths.OUT_DIR / 'extracted'
-    if extract_dir.exists():
-        shutil.rmtree(extract_dir)
+    deletion_service.delete(extract_dir)
     extract_dir.mkdir(parents=True, exist_ok=True)
 
     args: List[str] = ['tar', '-xjC', str(extract_dir), '-f', str(tarball)]
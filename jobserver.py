@@ -0,0 +1,142 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A GNU make jobserver shared by all make and ninja invocations."""
+
+import atexit
+import contextlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from typing import Iterator, Optional
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class JobServer:
+    """A FIFO jobserver, as understood by GNU make >= 4.4 and ninja >= 1.13.
+
+    Clients take a token from the FIFO before starting a job and put it back
+    when the job finishes. Every client may run one job without a token, so
+    the FIFO is filled with tokens - 1 tokens.
+    """
+
+    def __init__(self, tokens: int) -> None:
+        if tokens < 1:
+            raise ValueError(f'Invalid number of jobserver tokens: {tokens}')
+        self.tokens = tokens
+        self._dir = Path(tempfile.mkdtemp(prefix='llvm_android_jobserver.'))
+        self.path = self._dir / 'fifo'
+        os.mkfifo(self.path)
+        # Keep the FIFO open for reading and writing, so clients never see EOF
+        # and writing the tokens doesn't block.
+        self._fd: Optional[int] = os.open(self.path, os.O_RDWR)
+        os.write(self._fd, b'+' * (tokens - 1))
+        # Takes back free tokens without waiting for busy ones, see limit().
+        self._nonblocking_fd: Optional[int] = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self._withheld = b''
+        self._lock = threading.Lock()
+
+    @property
+    def makeflags(self) -> str:
+        """MAKEFLAGS for a client of this jobserver."""
+        return f'-j{self.tokens} --jobserver-auth=fifo:{self.path}'
+
+    @contextlib.contextmanager
+    def reserve(self, count: int) -> Iterator[None]:
+        """Holds count tokens for a client that doesn't use the jobserver, e.g. lit.
+
+        Blocks until the tokens are free, so other clients give up their share
+        of the cores to it.
+        """
+        count = min(count, self.tokens - 1)
+        taken = b''
+        while len(taken) < count:
+            taken += os.read(self._fd, count - len(taken))
+        try:
+            yield
+        finally:
+            os.write(self._fd, taken)
+
+    @property
+    def limit_tokens(self) -> int:
+        """The number of tokens handed out to clients, see limit()."""
+        return self.tokens - len(self._withheld)
+
+    def limit(self, tokens: int) -> int:
+        """Hands out at most tokens tokens from now on, to lower or raise concurrency.
+
+        Tokens that are in use are only taken back once their jobs finish, on
+        a later call. Returns the number of tokens handed out now.
+        """
+        withhold = self.tokens - max(1, min(tokens, self.tokens))
+        with self._lock:
+            if self._fd is None or self._nonblocking_fd is None:
+                # Closed.
+                return self.limit_tokens
+            if len(self._withheld) < withhold:
+                try:
+                    self._withheld += os.read(self._nonblocking_fd,
+                                              withhold - len(self._withheld))
+                except BlockingIOError:
+                    pass
+            elif len(self._withheld) > withhold:
+                os.write(self._fd, self._withheld[withhold:])
+                self._withheld = self._withheld[:withhold]
+            return self.limit_tokens
+
+    def close(self) -> None:
+        """Closes and removes the FIFO."""
+        with self._lock:
+            if self._nonblocking_fd is not None:
+                os.close(self._nonblocking_fd)
+                self._nonblocking_fd = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+_jobserver: Optional[JobServer] = None
+
+
+def start(tokens: int) -> JobServer:
+    """Starts the jobserver used by all builders."""
+    global _jobserver  # pylint: disable=global-statement
+    if _jobserver is not None:
+        raise RuntimeError('Jobserver already started')
+    _jobserver = JobServer(tokens)
+    atexit.register(stop)
+    logger().info('Started jobserver with %d tokens at %s', tokens, _jobserver.path)
+    return _jobserver
+
+
+def get() -> Optional[JobServer]:
+    """Returns the running jobserver, or None if there isn't one."""
+    return _jobserver
+
+
+def stop() -> None:
+    """Stops the running jobserver, if any."""
+    global _jobserver  # pylint: disable=global-statement
+    if _jobserver is not None:
+        _jobserver.close()
+        _jobserver = None
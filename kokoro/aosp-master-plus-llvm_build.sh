@@ -6,9 +6,10 @@ OUT=$TOP/out
 DIST=$TOP/dist
 
 # Kokoro will rsync back everything created by the build. Since we don't care
-# about any artifacts on this build, nuke EVERYTHING at the end of the build.
+# about any artifacts on this build, nuke EVERYTHING at the end of the build,
+# deleting the top-level entries in parallel.
 function cleanup {
-  rm -rf "${TOP}"/*
+  find "${TOP}" -mindepth 1 -maxdepth 1 ! -name '.*' -print0 | xargs -0 -r -P "$(nproc)" -n 1 rm -rf
 }
 trap cleanup EXIT
 
@@ -17,8 +17,12 @@ if (( $EUID == 0 )); then
 fi
 
 # Kokoro will rsync back everything created by the build. This can take up to 10
-# minutes for our out directory. Clean up these files at the end.
+# minutes for our out directory. Clean up these files at the end, deleting the
+# top-level entries in parallel.
 function cleanup {
+  if [ -d "${OUT}" ]; then
+    find "${OUT}" -mindepth 1 -maxdepth 1 -print0 | xargs -0 -r -P "$(nproc)" -n 1 rm -rf
+  fi
   rm -rf "${OUT}"
 }
 trap cleanup EXIT
@@ -0,0 +1,136 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Reads the SONAME of ELF and the install name of Mach-O shared libraries."""
+
+import functools
+import mmap
+import os
+from pathlib import Path
+import struct
+from typing import Iterator, Optional, Tuple
+
+_ELF_MAGIC = b'\x7fELF'
+_PT_LOAD = 1
+_PT_DYNAMIC = 2
+_DT_NULL = 0
+_DT_STRTAB = 5
+_DT_SONAME = 14
+
+_FAT_MAGIC = 0xcafebabe
+_MH_MAGIC = 0xfeedface
+_MH_MAGIC_64 = 0xfeedfacf
+_LC_ID_DYLIB = 0xd
+
+
+def _c_string(data: mmap.mmap, offset: int) -> str:
+    end = data.find(b'\0', offset)
+    return data[offset:end if end >= 0 else len(data)].decode()
+
+
+def _elf_soname(data: mmap.mmap) -> Optional[str]:
+    is_64 = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+    if is_64:
+        phoff, = struct.unpack_from(endian + 'Q', data, 0x20)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 0x36)
+        # p_type, p_offset, p_vaddr, p_filesz
+        phdr_format, phdr_fields = endian + 'IIQQQQ', (0, 2, 3, 5)
+        dyn_format = endian + 'qQ'
+    else:
+        phoff, = struct.unpack_from(endian + 'I', data, 0x1c)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 0x2a)
+        phdr_format, phdr_fields = endian + 'IIIIII', (0, 1, 2, 4)
+        dyn_format = endian + 'iI'
+
+    loads = []
+    dynamic: Optional[Tuple[int, int]] = None
+    for index in range(phnum):
+        fields = struct.unpack_from(phdr_format, data, phoff + index * phentsize)
+        p_type, p_offset, p_vaddr, p_filesz = (fields[field] for field in phdr_fields)
+        if p_type == _PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == _PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+    if dynamic is None:
+        return None
+
+    strtab = soname = None
+    dyn_size = struct.calcsize(dyn_format)
+    for offset in range(dynamic[0], dynamic[0] + dynamic[1], dyn_size):
+        tag, value = struct.unpack_from(dyn_format, data, offset)
+        if tag == _DT_NULL:
+            break
+        if tag == _DT_STRTAB:
+            strtab = value
+        elif tag == _DT_SONAME:
+            soname = value
+    if strtab is None or soname is None:
+        return None
+    # DT_STRTAB is an address, which the loadable segments map to the file.
+    for p_vaddr, p_offset, p_filesz in loads:
+        if p_vaddr <= strtab < p_vaddr + p_filesz:
+            return _c_string(data, strtab - p_vaddr + p_offset + soname)
+    return None
+
+
+def _macho_slices(data: mmap.mmap) -> Iterator[int]:
+    """Yields the offsets of the Mach-O images in a fat or thin file."""
+    magic, = struct.unpack_from('>I', data, 0)
+    if magic == _FAT_MAGIC:
+        nfat_arch, = struct.unpack_from('>I', data, 4)
+        for index in range(nfat_arch):
+            # cputype, cpusubtype, offset, size, align
+            yield struct.unpack_from('>IIIII', data, 8 + index * 20)[2]
+    else:
+        yield 0
+
+
+def _macho_install_name(data: mmap.mmap) -> Optional[str]:
+    for start in _macho_slices(data):
+        for endian in '<>':
+            magic, = struct.unpack_from(endian + 'I', data, start)
+            if magic in (_MH_MAGIC, _MH_MAGIC_64):
+                break
+        else:
+            continue
+        ncmds, = struct.unpack_from(endian + 'I', data, start + 16)
+        offset = start + (32 if magic == _MH_MAGIC_64 else 28)
+        for _ in range(ncmds):
+            cmd, cmdsize, name_offset = struct.unpack_from(endian + 'III', data, offset)
+            if cmd == _LC_ID_DYLIB:
+                return _c_string(data, offset + name_offset)
+            offset += cmdsize
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _read(path: str, mtime_ns: int, size: int) -> Optional[str]:  # pylint: disable=unused-argument
+    if size < 64:
+        return None
+    with open(path, 'rb') as lib_file:
+        with mmap.mmap(lib_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] == _ELF_MAGIC:
+                return _elf_soname(data)
+            return _macho_install_name(data)
+
+
+def read(path: Path) -> Optional[str]:
+    """Returns the SONAME or LC_ID_DYLIB install name of a shared library, if it has one.
+
+    Results are cached until the library is modified.
+    """
+    stat = os.stat(path)
+    return _read(str(path), stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Runs a link command and records its peak RSS.
+
+Used as a CMake linker launcher:
+    link_rss.py <log file> <link command...>
+"""
+
+import os
+import subprocess
+import sys
+
+
+def main() -> int:
+    log_file = sys.argv[1]
+    cmd = sys.argv[2:]
+    target = 'unknown'
+    if '-o' in cmd[:-1]:
+        target = os.path.basename(cmd[cmd.index('-o') + 1])
+
+    proc = subprocess.Popen(cmd)
+    # The rusage of a child also covers the children it waited for, like the
+    # linker started by the clang driver.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    with open(log_file, 'a') as log:
+        log.write(f'{target}\t{rusage.ru_maxrss}\n')
+    return proc.returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
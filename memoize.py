@@ -0,0 +1,92 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Memoizes the flags of configs and builders."""
+
+import copy
+import functools
+from typing import Any, Dict, FrozenSet, Hashable, Tuple
+
+import utils
+
+
+# Bumped by invalidate_all().
+_generation: int = 0
+
+
+def invalidate_all() -> None:
+    """Forgets all memoized values, e.g. after global state they depend on changed."""
+    global _generation  # pylint: disable=global-statement
+    _generation += 1
+
+
+def _memoized(cls: type, name: str, prop: property) -> property:
+    @functools.wraps(prop.fget)
+    def getter(self) -> Any:
+        memo: Dict[Hashable, Any] = self.__dict__.setdefault('_memo', {})
+        key = (cls, name, _generation, self._memo_key())
+        if key not in memo:
+            memo[key] = prop.fget(self)
+        # Callers, e.g. overrides calling super(), extend the returned value.
+        return copy.copy(memo[key])
+    return property(getter)
+
+
+class Memoized:
+    """Memoizes the properties in memoized_properties, in this class and all subclasses.
+
+    Values are memoized per object and per _memo_key(). Setting an attribute
+    of the object forgets its values, except for the attributes in
+    _memo_key_attributes, which _memo_key() covers instead.
+    """
+
+    memoized_properties: FrozenSet[str] = frozenset()
+    _memo_key_attributes: FrozenSet[str] = frozenset()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        for name in cls.memoized_properties:
+            prop = cls.__dict__.get(name)
+            if isinstance(prop, property):
+                setattr(cls, name, _memoized(cls, name, prop))
+
+    def _memo_key(self) -> Tuple[Hashable, ...]:
+        """State other than attributes that the memoized properties depend on."""
+        return ()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name not in self._memo_key_attributes:
+            self.__dict__.pop('_memo', None)
+        super().__setattr__(name, value)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Memoized values aren't valid where the object is unpickled, e.g. on a
+        # remote worker with other paths.
+        state = dict(self.__dict__)
+        state.pop('_memo', None)
+        return state
+
+    def invalidate(self) -> None:
+        """Forgets the memoized values of this object."""
+        self.__dict__.pop('_memo', None)
+
+
+def fingerprint(obj: Memoized, name: str) -> str:
+    """Returns a stable hash of the property name of obj, memoized along with it."""
+    memo: Dict[Hashable, Any] = obj.__dict__.setdefault('_memo', {})
+    key = ('fingerprint', name, _generation, obj._memo_key())  # pylint: disable=protected-access
+    if key not in memo:
+        memo[key] = utils.fingerprint(getattr(obj, name))
+    return memo[key]
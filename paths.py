@@ -119,8 +119,8 @@ def mlgo_model(filename: str) -> Optional[Path]:
     return model if model.exists() else None
 
 
-def get_package_install_path(host: hosts.Host, package_name) -> Path:
-    return OUT_DIR / 'install' / host.os_tag / package_name
+def get_package_install_path(host: hosts.Host, package_name, musl: bool = False) -> Path:
+    return OUT_DIR / 'install' / (host.os_tag_musl if musl else host.os_tag) / package_name
 
 def get_python_dir(host: hosts.Host) -> Path:
     """Returns the path to python for a host."""
@@ -0,0 +1,154 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Adapts the concurrency of the jobserver to the CPU, memory and IO pressure of the host."""
+
+import atexit
+import collections
+import logging
+import os
+import threading
+from typing import Deque, Dict, NamedTuple, Optional
+
+import jobserver
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class Pressure(NamedTuple):
+    """Pressure of the host.
+
+    cpu, memory and io are the percentages of the last 10s that some tasks
+    stalled on them. load is the 1 minute loadavg per core.
+    """
+    cpu: float
+    memory: float
+    io: float
+    load: float
+
+
+# The host is stalled if any of these is exceeded, after discounting the load
+# and CPU pressure of the build itself...
+STALLED = Pressure(cpu=80, memory=10, io=40, load=1.0)
+# ... and calm again once none of these is.
+CALM = Pressure(cpu=40, memory=2, io=10, load=0.5)
+
+
+def read_pressure(resource: str) -> Optional[float]:
+    """Returns the 'some avg10' of /proc/pressure/resource, or None without PSI."""
+    try:
+        with open(f'/proc/pressure/{resource}') as pressure_file:
+            fields = pressure_file.readline().split()
+    except OSError:
+        return None
+    for field in fields[1:]:
+        key, _, value = field.partition('=')
+        if key == 'avg10':
+            return float(value)
+    return None
+
+
+def sample() -> Pressure:
+    """Returns the current pressure of the host. Missing PSI counts as no pressure."""
+    return Pressure(
+        cpu=read_pressure('cpu') or 0.0,
+        memory=read_pressure('memory') or 0.0,
+        io=read_pressure('io') or 0.0,
+        load=os.getloadavg()[0] / (os.cpu_count() or 1))
+
+
+class PressureMonitor:
+    """Lowers the tokens the jobserver hands out while the host is stalled.
+
+    Other tenants of a shared host compete for the same cores, memory and
+    disks, so a fixed number of jobs can oversubscribe it. While the host is
+    stalled, a quarter of the tokens handed out are taken back at every
+    sample, down to min_tokens. Once it is calm, tokens are handed out again
+    an eighth of the total at a time.
+
+    The build's own jobs add to the loadavg, and stall on the CPU once there
+    are more of them than cores. Both are discounted by the tokens handed
+    out over the last minute, the window of the loadavg, so an otherwise
+    idle host doesn't throttle the build. Memory and IO stalls aren't
+    discounted: fewer jobs help even if the build causes them itself.
+    """
+
+    def __init__(self, server: jobserver.JobServer, interval: float = 10.0) -> None:
+        self.server = server
+        self.interval = interval
+        self.min_tokens = max(1, server.tokens // 4)
+        # The tokens handed out at the last samples, back to a minute ago.
+        self._recent_tokens: Deque[int] = collections.deque(maxlen=max(1, round(60 / interval)))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _discount(self, pressure: Pressure) -> Pressure:
+        """Returns the pressure without the share the build causes with its tokens."""
+        cores = os.cpu_count() or 1
+        self._recent_tokens.append(self.server.limit_tokens)
+        tokens = max(self._recent_tokens)
+        # Jobs beyond the number of cores wait for one some of the time.
+        own_cpu = max(0.0, 1 - cores / tokens) * 100
+        return pressure._replace(cpu=max(0.0, pressure.cpu - own_cpu),
+                                 load=max(0.0, pressure.load - tokens / cores))
+
+    def _target(self, pressure: Pressure) -> int:
+        current = self.server.limit_tokens
+        if any(value > limit for value, limit in zip(pressure, STALLED)):
+            return max(self.min_tokens, current - max(1, current // 4))
+        if all(value <= limit for value, limit in zip(pressure, CALM)):
+            return min(self.server.tokens, current + max(1, self.server.tokens // 8))
+        return current
+
+    def adjust(self) -> None:
+        """Samples the pressure once, and lowers or raises the tokens handed out."""
+        pressure = self._discount(sample())
+        before = self.server.limit_tokens
+        after = self.server.limit(self._target(pressure))
+        if after != before:
+            logger().info('Pressure %s: handing out %d of %d jobserver tokens, was %d',
+                          self._format(pressure), after, self.server.tokens, before)
+
+    @staticmethod
+    def _format(pressure: Pressure) -> str:
+        values: Dict[str, float] = pressure._asdict()
+        return ', '.join(f'{name}={value:.1f}' for name, value in values.items())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.adjust()
+
+    def start(self) -> None:
+        """Starts adjusting in a background thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops adjusting, and hands out all tokens again."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.server.limit(self.server.tokens)
+
+
+def start(server: jobserver.JobServer) -> PressureMonitor:
+    """Adapts the tokens of server to the pressure of the host until exit."""
+    monitor = PressureMonitor(server)
+    monitor.start()
+    atexit.register(monitor.stop)
+    logger().info('Adapting jobserver tokens to host pressure, down to %d', monitor.min_tokens)
+    return monitor
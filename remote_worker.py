@@ -0,0 +1,441 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Builds configs of builders on worker processes, on this host or others.
+
+Run this script on a worker host, from the same checkout as the build, to
+serve do_build.py --remote-workers. The worker's OUT_DIR may differ from the
+build's: paths of the build are mapped to the worker's OUT_DIR and checkout.
+
+A job ships the builder, bound to one config, and its toolchains to a
+worker. The worker
+first syncs the inputs of the build (builder.remote_inputs) with the files
+the build sends, builds the config and then streams back the files it
+changed in builder.remote_outputs. Files are compared by size and mtime,
+to the second, so unchanged inputs are only sent once.
+"""
+
+import argparse
+import atexit
+import io
+from multiprocessing import connection
+import logging
+import os
+from pathlib import Path, PosixPath
+import pickle
+import queue
+import secrets
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+import traceback
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import paths
+import toolchains
+
+
+# The key that workers and builds authenticate each other with.
+AUTHKEY_ENV = 'BUILD_WORKER_AUTHKEY'
+
+_CHUNK_SIZE = 1024 * 1024
+
+# (size, mtime) of a file, or the target of a symlink.
+_FileStat = Union[Tuple[int, int], str]
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+def _snapshot(roots: Iterable[str]) -> Dict[str, _FileStat]:
+    """Returns the files under roots, relative to OUT_DIR."""
+    files: Dict[str, _FileStat] = {}
+    for root in roots:
+        for dirpath, _, filenames in os.walk(paths.OUT_DIR / root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, paths.OUT_DIR)
+                if os.path.islink(path):
+                    files[key] = os.readlink(path)
+                else:
+                    stat = os.stat(path)
+                    files[key] = (stat.st_size, int(stat.st_mtime))
+    return files
+
+
+class _ConnectionWriter(io.RawIOBase):
+    """Writes a stream as byte messages to a connection."""
+
+    def __init__(self, conn: connection.Connection) -> None:
+        super().__init__()
+        self._conn = conn
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if data:
+            self._conn.send_bytes(data)
+        return len(data)
+
+
+class _ConnectionReader(io.RawIOBase):
+    """Reads a stream of byte messages from a connection, up to an empty message."""
+
+    def __init__(self, conn: connection.Connection) -> None:
+        super().__init__()
+        self._conn = conn
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            self._buffer = self._conn.recv_bytes()
+            self._eof = not self._buffer
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _send_files(conn: connection.Connection, files: Iterable[str]) -> None:
+    """Sends files, relative to OUT_DIR, as a tar stream."""
+    with io.BufferedWriter(_ConnectionWriter(conn), _CHUNK_SIZE) as stream:
+        with tarfile.open(fileobj=stream, mode='w|') as tar:
+            for name in files:
+                tar.add(paths.OUT_DIR / name, arcname=name, recursive=False)
+    conn.send_bytes(b'')
+
+
+def _receive_files(conn: connection.Connection) -> int:
+    """Extracts a tar stream from _send_files into OUT_DIR. Returns the number of files."""
+    count = 0
+    with io.BufferedReader(_ConnectionReader(conn), _CHUNK_SIZE) as stream:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            # Workers and builds authenticate each other, and links may point
+            # anywhere in OUT_DIR.
+            if hasattr(tarfile, 'fully_trusted_filter'):
+                tar.extraction_filter = tarfile.fully_trusted_filter
+            for member in tar:
+                dest = paths.OUT_DIR / member.name
+                # Replace files rather than write through links to them.
+                if dest.is_symlink() or dest.is_file():
+                    dest.unlink()
+                tar.extract(member, paths.OUT_DIR)
+                count += 1
+        # Skip the padding after the end of the archive.
+        while stream.read(_CHUNK_SIZE):
+            pass
+    return count
+
+
+def _in_out_dir(dirs: Iterable[Path]) -> List[str]:
+    """Returns the dirs in OUT_DIR, relative to it. Workers have the others in their checkout."""
+    return [str(path.relative_to(paths.OUT_DIR)) for path in dirs
+            if path.is_relative_to(paths.OUT_DIR)]
+
+
+def _toolchain_paths(toolchain: Optional[toolchains.Toolchain]) -> Optional[Tuple[str, str]]:
+    if toolchain is None:
+        return None
+    return (str(toolchain.path), str(toolchain.build_path))
+
+
+class _PathMappingUnpickler(pickle.Unpickler):
+    """Unpickles paths of the build as paths of this worker."""
+
+    def __init__(self, data: bytes, path_map: List[Tuple[Path, Path]]) -> None:
+        super().__init__(io.BytesIO(data))
+        self.path_map = path_map
+
+    def _map_path(self, *parts: str) -> Path:
+        path = PosixPath(*parts)
+        for build_dir, worker_dir in self.path_map:
+            if path.is_relative_to(build_dir):
+                return worker_dir / path.relative_to(build_dir)
+        return path
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module == 'pathlib' and name == 'PosixPath':
+            return self._map_path
+        return super().find_class(module, name)
+
+    def toolchain(self,
+                  toolchain_paths: Optional[Tuple[str, str]]) -> Optional[toolchains.Toolchain]:
+        """Returns the toolchain at the paths from _toolchain_paths, mapped to this worker."""
+        if toolchain_paths is None:
+            return None
+        path, build_path = toolchain_paths
+        return toolchains.Toolchain(self._map_path(path), self._map_path(build_path))
+
+
+class WorkerPool:
+    """Builds configs on the workers listening at addresses, one job per worker at a time."""
+
+    def __init__(self, addresses: List[Tuple[str, int]], authkey: bytes) -> None:
+        self.authkey = authkey
+        self._free: queue.Queue = queue.Queue()
+        for address in addresses:
+            self._free.put(address)
+
+    def _run_job(self, conn: connection.Connection, builder) -> None:
+        inputs = _in_out_dir(builder.remote_inputs)
+        conn.send({
+            'builder': pickle.dumps(builder),
+            # do_build.py sets the toolchains as class attributes, which
+            # aren't pickled with the builder.
+            'toolchain': _toolchain_paths(builder.toolchain),
+            'output_toolchain': _toolchain_paths(getattr(builder, 'output_toolchain', None)),
+            'out_dir': str(paths.OUT_DIR),
+            'android_dir': str(paths.ANDROID_DIR),
+            'inputs': inputs,
+            'outputs': _in_out_dir(builder.remote_outputs),
+            'files': _snapshot(inputs),
+        })
+        _send_files(conn, conn.recv())
+        error = conn.recv()
+        if error:
+            raise RuntimeError(f'{builder.step_name} failed on a worker:\n{error}')
+        _receive_files(conn)
+
+    def build(self, builder) -> bool:
+        """Builds the current config of builder on the next free worker.
+
+        Returns False if the worker can't be reached, so the config must be
+        built locally.
+        """
+        if not all(path.is_relative_to(paths.OUT_DIR) for path in builder.remote_outputs):
+            logger().info('Building %s locally: it installs outside of OUT_DIR',
+                          builder.step_name)
+            return False
+        address = self._free.get()
+        try:
+            start = time.time()
+            with connection.Client(address, authkey=self.authkey) as conn:
+                logger().info('Building %s on worker %s:%d', builder.step_name, *address)
+                self._run_job(conn, builder)
+            logger().info('Built %s on worker %s:%d in %.1fs', builder.step_name, *address,
+                          time.time() - start)
+            return True
+        except (EOFError, OSError, connection.AuthenticationError) as e:
+            logger().warning('Worker %s:%d failed, building %s locally: %s', *address,
+                             builder.step_name, e)
+            return False
+        finally:
+            self._free.put(address)
+
+
+class LocalWorkerPool(WorkerPool):
+    """Worker processes on this host, each with an OUT_DIR of its own.
+
+    Jobs go through the same protocol as with remote workers, so this is a
+    stand-in for them when testing.
+    """
+
+    def __init__(self, count: int) -> None:
+        authkey = secrets.token_hex(32)
+        self._processes: List[subprocess.Popen] = []
+        addresses = []
+        for index in range(count):
+            worker_dir = paths.OUT_DIR / 'workers' / str(index)
+            port_file = worker_dir / 'port'
+            worker_dir.mkdir(parents=True, exist_ok=True)
+            port_file.unlink(missing_ok=True)
+            env = dict(os.environ, OUT_DIR=str(worker_dir), **{AUTHKEY_ENV: authkey})
+            self._processes.append(subprocess.Popen(
+                [sys.executable, __file__, '--bind', '127.0.0.1', '--port', '0',
+                 '--port-file', str(port_file)], env=env))
+            addresses.append(('127.0.0.1', self._wait_for_port(port_file)))
+        atexit.register(self.stop)
+        super().__init__(addresses, authkey.encode())
+
+    def _wait_for_port(self, port_file: Path, timeout: float = 60) -> int:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if port_file.exists() and (port := port_file.read_text().strip()):
+                return int(port)
+            if self._processes[-1].poll() is not None:
+                break
+            time.sleep(0.1)
+        raise RuntimeError(f'Local worker {port_file.parent} did not start')
+
+    def stop(self) -> None:
+        """Stops the worker processes."""
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.wait()
+
+
+def _serve_job(conn: connection.Connection) -> None:
+    job = conn.recv()
+    unpickler = _PathMappingUnpickler(job['builder'], [
+        (Path(job['out_dir']), paths.OUT_DIR),
+        (Path(job['android_dir']), paths.ANDROID_DIR),
+    ])
+    builder = unpickler.load()
+    builder.toolchain = unpickler.toolchain(job['toolchain'])
+    if output_toolchain := unpickler.toolchain(job['output_toolchain']):
+        builder.output_toolchain = output_toolchain
+    logger().info('Building %s', builder.step_name)
+
+    # Mirror the inputs of the build.
+    files = _snapshot(job['inputs'])
+    for name in files.keys() - job['files'].keys():
+        (paths.OUT_DIR / name).unlink()
+    conn.send([name for name, stat in job['files'].items() if files.get(name) != stat])
+    logger().info('Synced %d input files', _receive_files(conn))
+
+    before = _snapshot(job['outputs'])
+    try:
+        builder._build_config()  # pylint: disable=protected-access
+    except Exception:  # pylint: disable=broad-except
+        logger().exception('Failed to build %s', builder.step_name)
+        conn.send(traceback.format_exc())
+        return
+    conn.send(None)
+    after = _snapshot(job['outputs'])
+    _send_files(conn, [name for name, stat in after.items() if before.get(name) != stat])
+
+
+def serve(address: Tuple[str, int], authkey: bytes, port_file: Optional[Path]) -> None:
+    """Serves jobs, one at a time."""
+    with connection.Listener(address, authkey=authkey) as listener:
+        port = listener.address[1]
+        print(f'Serving {paths.OUT_DIR} on {address[0]}:{port}')
+        if port_file:
+            port_file.write_text(f'{port}\n')
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, connection.AuthenticationError) as e:
+                logger().warning('Rejected connection: %s', e)
+                continue
+            with conn:
+                try:
+                    _serve_job(conn)
+                except (EOFError, OSError) as e:
+                    logger().warning('Lost connection: %s', e)
+
+
+class _SelfTestBuilder:
+    """Stands in for a builder in self_test().
+
+    Like do_build.py does for builders, self_test() sets its toolchains on
+    the class.
+    """
+
+    step_name: str = 'remote-worker-self-test'
+    toolchain: toolchains.Toolchain
+    output_toolchain: toolchains.Toolchain
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    @property
+    def remote_inputs(self) -> List[Path]:
+        return [self.root / 'input']
+
+    @property
+    def remote_outputs(self) -> List[Path]:
+        return [self.root / 'output']
+
+    def _build_config(self) -> None:
+        output = self.root / 'output'
+        output.mkdir(parents=True, exist_ok=True)
+        (output / 'result').write_text('\n'.join([
+            (self.root / 'input' / 'token').read_text(),
+            str(self.toolchain.path),
+            str(self.output_toolchain.path),
+        ]))
+
+
+def self_test() -> None:
+    """Builds a job on a LocalWorkerPool, and checks that it ran with the inputs and
+    toolchains of the build."""
+    root = paths.OUT_DIR / 'remote-worker-self-test'
+    shutil.rmtree(root, ignore_errors=True)
+    (root / 'input').mkdir(parents=True)
+    token = secrets.token_hex(8)
+    (root / 'input' / 'token').write_text(token)
+    _SelfTestBuilder.toolchain = toolchains.Toolchain(root / 'toolchain', root / 'build')
+    _SelfTestBuilder.output_toolchain = toolchains.Toolchain(root / 'output-toolchain',
+                                                             root / 'build')
+
+    pool = LocalWorkerPool(1)
+    try:
+        if not pool.build(_SelfTestBuilder(root)):
+            raise RuntimeError('The local worker failed to build the job')
+    finally:
+        pool.stop()
+
+    worker_root = paths.OUT_DIR / 'workers' / '0' / root.relative_to(paths.OUT_DIR)
+    expected = [token, str(worker_root / 'toolchain'), str(worker_root / 'output-toolchain')]
+    result = (root / 'output' / 'result').read_text().splitlines()
+    if result != expected:
+        raise RuntimeError(f'The local worker built with {result}, expected {expected}')
+    shutil.rmtree(root)
+    print('Remote worker self test passed')
+
+
+_pool: Optional[WorkerPool] = None
+
+
+def start(pool: WorkerPool) -> WorkerPool:
+    """Builds the configs of remote buildable builders on pool."""
+    global _pool  # pylint: disable=global-statement
+    _pool = pool
+    return _pool
+
+
+def get() -> Optional[WorkerPool]:
+    """Returns the worker pool, or None if configs are built locally."""
+    return _pool
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8090,
+                        help='Port to listen on. 0 picks a free port.')
+    parser.add_argument('--bind', default='localhost', help='Address to listen on.')
+    parser.add_argument('--port-file', type=Path, help='File to write the port to.')
+    parser.add_argument('--self-test', action='store_true',
+                        help='Build a test job on a worker process on this host, check that '
+                        'it ran with the inputs and toolchains of the build, and exit.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.self_test:
+        self_test()
+        return
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        sys.exit(f'${AUTHKEY_ENV} must be set to the key shared with the build')
+    serve((args.bind, args.port), authkey.encode(), args.port_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Helpers to inspect and track host resources used by the build."""
+
+import json
+import logging
+from pathlib import Path
+import tempfile
+import threading
+from typing import Dict, Optional
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+GiB: int = 1024 ** 3
+
+
+def meminfo() -> Dict[str, int]:
+    """Returns /proc/meminfo in bytes, or an empty dict if it isn't available."""
+    result: Dict[str, int] = {}
+    try:
+        with open('/proc/meminfo') as meminfo_file:
+            for line in meminfo_file:
+                key, value = line.split(':', 1)
+                fields = value.split()
+                size = int(fields[0])
+                if len(fields) > 1 and fields[1] == 'kB':
+                    size *= 1024
+                result[key] = size
+    except OSError:
+        pass
+    return result
+
+
+def available_memory() -> Optional[int]:
+    """Returns the memory available for new processes in bytes, if known."""
+    return meminfo().get('MemAvailable')
+
+
+class PeakRssHistory:
+    """Peak RSS of link steps, kept across builds in a json file.
+
+    The link steps append '<target>\t<peak RSS in KiB>' lines to a log (see
+    link_rss.py), which is merged into the history after the build.
+    """
+
+    # Concurrent builds, e.g. of the glibc and musl stage2s, merge their logs
+    # into the same history.
+    _lock = threading.Lock()
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def load(self) -> Dict[str, int]:
+        """Returns the peak RSS in bytes of each recorded target."""
+        try:
+            with self.path.open() as history_file:
+                return json.load(history_file)
+        except (OSError, ValueError):
+            return {}
+
+    def peak(self) -> Optional[int]:
+        """Returns the largest recorded peak RSS in bytes."""
+        return max(self.load().values(), default=None)
+
+    def merge_log(self, log_file: Path) -> None:
+        """Merges a log written by link_rss.py into the history, then deletes it."""
+        if not log_file.exists():
+            return
+        with self._lock:
+            history = self.load()
+            with log_file.open() as log:
+                for line in log:
+                    target, _, rss_kib = line.rstrip('\n').rpartition('\t')
+                    if not target or not rss_kib.isdigit():
+                        continue
+                    # Keep the latest measurement, so the history follows changes in
+                    # the size of the targets.
+                    history[target] = int(rss_kib) * 1024
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=self.path.parent,
+                                             prefix=f'.{self.path.name}.',
+                                             delete=False) as history_file:
+                json.dump(history, history_file, indent=2, sort_keys=True)
+            Path(history_file.name).replace(self.path)
+            log_file.unlink()
+
+
+"""Peak RSS assumed for a ThinLTO link before any link was measured."""
+DEFAULT_LINK_RSS: int = 12 * GiB
+
+
+def link_jobs(history: PeakRssHistory, cpu_limit: int, concurrent_builds: int = 1) -> int:
+    """Returns how many links can run concurrently without exhausting memory.
+
+    The limit is the available memory, split evenly between concurrent_builds
+    builds that link at the same time, divided by the largest peak RSS of a
+    link in previous builds, capped by cpu_limit. The decision is logged.
+    """
+    available = available_memory()
+    if available is None:
+        logger().info('Link jobs: %d (available memory unknown, using the CPU limit)',
+                      cpu_limit)
+        return cpu_limit
+    if concurrent_builds > 1:
+        logger().info('Link jobs: sharing %.1f GiB available memory between %d builds',
+                      available / GiB, concurrent_builds)
+        available //= concurrent_builds
+    peak = history.peak()
+    source = f'peak link RSS from {history.path}'
+    if peak is None:
+        peak = DEFAULT_LINK_RSS
+        source = 'default link RSS, no history yet'
+    jobs = max(1, min(cpu_limit, available // peak))
+    logger().info('Link jobs: %d (%.1f GiB available / %.1f GiB %s = %d, CPU limit %d)',
+                  jobs, available / GiB, peak / GiB, source, available // peak, cpu_limit)
+    return jobs
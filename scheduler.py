@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A scheduler to run independent build steps concurrently."""
+
+from concurrent import futures
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import build_plan
+import timer
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class Task:
+    """A named build step and the names of the steps it depends on."""
+
+    def __init__(self, name: str, function: Callable[[], None], deps: Iterable[str],
+                 records_steps: bool = False) -> None:
+        self.name = name
+        self.function = function
+        self.deps: Set[str] = set(deps)
+        # Whether function records its own steps when planning, like
+        # Builder.build(), instead of being a single step.
+        self.records_steps = records_steps
+
+
+class Scheduler:
+    """Runs tasks in dependency order, with at most max_jobs tasks at a time.
+
+    Dependencies on tasks that were not added to the scheduler are considered
+    satisfied, so a builder can list everything it may need and still be
+    scheduled on its own. Ready tasks are started in the order they were added,
+    so max_jobs=1 reproduces the order of the equivalent serial code.
+    """
+
+    """Default number of concurrent tasks, set from the command line."""
+    default_jobs: int = 1
+
+    def __init__(self, max_jobs: Optional[int] = None) -> None:
+        self.max_jobs: int = max(1, max_jobs or self.default_jobs)
+        self._tasks: Dict[str, Task] = {}
+
+    def add(self, name: str, function: Callable[[], None], deps: Iterable[str] = (),
+            records_steps: bool = False) -> None:
+        """Adds a task that runs function after all tasks in deps are done."""
+        if name in self._tasks:
+            raise ValueError(f'Duplicate task {name}')
+        self._tasks[name] = Task(name, function, deps, records_steps)
+
+    def add_builder(self, builder, deps: Optional[Iterable[str]] = None,
+                    name: Optional[str] = None) -> None:
+        """Adds a task for builder.build(), using builder.depends_on by default.
+
+        The task is named after the builder, unless name is set.
+        """
+        if deps is None:
+            deps = builder.depends_on
+        self.add(name or builder.name, builder.build, deps, records_steps=True)
+
+    @property
+    def tasks(self) -> List[Task]:
+        """Tasks in the order they were added."""
+        return list(self._tasks.values())
+
+    def _plan(self, plan: build_plan.Plan) -> None:
+        """Records the tasks in plan. Builders record their own configs."""
+        with plan.group(self.max_jobs) as group:
+            for task in self.tasks:
+                with plan.task(group, task.name, task.deps & self._tasks.keys()):
+                    if task.records_steps:
+                        task.function()
+                    else:
+                        plan.record_step(task.name)
+
+    def _pending_deps(self) -> Dict[str, Set[str]]:
+        pending = {name: task.deps & self._tasks.keys() for name, task in self._tasks.items()}
+        # Reject cycles before starting anything.
+        resolved: Set[str] = set()
+        remaining = dict(pending)
+        while remaining:
+            ready = [name for name, deps in remaining.items() if deps <= resolved]
+            if not ready:
+                raise RuntimeError('Dependency cycle between tasks: ' +
+                                   ', '.join(sorted(remaining)))
+            for name in ready:
+                resolved.add(name)
+                del remaining[name]
+        return pending
+
+    def _run_task(self, task: Task, after: List[str], ends: Dict[str, List[str]]) -> None:
+        # Record that the steps of task wait for after, for the build report.
+        timer.Timer.set_frontier(after)
+        task.function()
+        ends[task.name] = timer.Timer.frontier()
+
+    def run(self) -> None:
+        """Runs all tasks. Raises the first task failure after running tasks finish."""
+        pending = self._pending_deps()
+        if plan := build_plan.get():
+            self._plan(plan)
+            return
+        # The last steps before the scheduler, and of each finished task.
+        before = timer.Timer.frontier()
+        ends: Dict[str, List[str]] = {}
+        done: Set[str] = set()
+        error: Optional[BaseException] = None
+        with futures.ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            running: Dict[futures.Future, str] = {}
+            while pending or running:
+                if error is None:
+                    for name in list(pending):
+                        if len(running) >= self.max_jobs:
+                            break
+                        if pending[name] <= done:
+                            after = [step for dep in sorted(self._tasks[name].deps & done)
+                                     for step in ends[dep]] or before
+                            del pending[name]
+                            logger().info('Starting %s', name)
+                            running[executor.submit(self._run_task, self._tasks[name],
+                                                    after, ends)] = name
+                if not running:
+                    break
+                finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        done.add(name)
+                    elif error is None:
+                        logger().error('%s failed: %s', name, exception)
+                        error = exception
+        timer.Timer.set_frontier(step for steps in ends.values() for step in steps)
+        if error is not None:
+            raise error
@@ -17,16 +17,19 @@
 Package to manage LLVM sources when building a toolchain.
 """
 
+import functools
+import hashlib
 import logging
 from pathlib import Path
 import os
 import re
-import shutil
 import string
 import subprocess
 import sys
+from typing import Optional, Tuple
 
 import android_version
+import deletion_service
 import hosts
 import paths
 import utils
@@ -115,6 +118,52 @@ def write_source_info(source_dir: str, patch_output: str) -> None:
         outfile.write('\n'.join(output))
 
 
+# The llvm_rev and skip_apply_patches that the sources in paths.LLVM_PATH are
+# set up with.
+_llvm_source_options: Tuple[Optional[str], bool] = (None, False)
+
+
+def set_llvm_source_options(llvm_rev: Optional[str] = None,
+                            skip_apply_patches: bool = False) -> None:
+    """Sets the options of setup_sources() that source fingerprints of LLVM_PATH depend on."""
+    global _llvm_source_options  # pylint: disable=global-statement
+    _llvm_source_options = (llvm_rev, skip_apply_patches)
+    source_fingerprint.cache_clear()
+
+
+@functools.lru_cache
+def llvm_source_fingerprint(llvm_rev=None, skip_apply_patches=False) -> str:
+    """Returns a fingerprint of the sources set up by setup_sources()."""
+    patches = hashlib.sha256()
+    if not skip_apply_patches:
+        patch_dir = paths.SCRIPTS_DIR / 'patches'
+        for patch_file in sorted(patch_dir.rglob('*')):
+            if patch_file.is_file():
+                patches.update(str(patch_file.relative_to(patch_dir)).encode())
+                patches.update(patch_file.read_bytes())
+    return utils.fingerprint({
+        'revision': llvm_rev or android_version.get_git_sha(),
+        'patches': patches.hexdigest(),
+    })
+
+
+@functools.lru_cache
+def source_fingerprint(source_dir: Path) -> str:
+    """Returns a fingerprint of the sources in source_dir."""
+    if source_dir == paths.LLVM_PATH or paths.LLVM_PATH in source_dir.parents:
+        return llvm_source_fingerprint(*_llvm_source_options)
+    # Other sources are checked out by repo, so use their git revision and
+    # local changes.
+    def git(*args: str) -> str:
+        return subprocess.run(['git', '-C', str(source_dir)] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              text=True).stdout
+    revision = git('rev-parse', 'HEAD').strip()
+    if not revision:
+        return str(source_dir)
+    return utils.fingerprint([revision, git('status', '--porcelain'), git('diff', 'HEAD')])
+
+
 def setup_sources(llvm_rev=None, skip_apply_patches=False):
     """Setup toolchain sources into paths.LLVM_PATH.
 
@@ -126,8 +175,7 @@ def setup_sources(llvm_rev=None, skip_apply_patches=False):
 
     source_dir = paths.LLVM_PATH
     tmp_source_dir = source_dir.parent / (source_dir.name + '.tmp')
-    if os.path.exists(tmp_source_dir):
-        shutil.rmtree(tmp_source_dir)
+    deletion_service.delete(tmp_source_dir)
 
     # mkdir parent of tmp_source_dir if necessary.
     tmp_source_parent = os.path.dirname(tmp_source_dir)
@@ -190,7 +238,7 @@ def setup_sources(llvm_rev=None, skip_apply_patches=False):
         # subprocess.check_call(['rsync', '-r', '--delete', '--links', '-c',
         #                        tmp_source_dir_str, source_dir])
 
-        shutil.rmtree(tmp_source_dir)
+        deletion_service.delete(tmp_source_dir)
     remote, url = try_set_git_remote(source_dir)
     logger().info(f'git remote url: remote: {remote} url: {url}')
 
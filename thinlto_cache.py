@@ -0,0 +1,124 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A ThinLTO cache that persists across builds, so relinks only redo the codegen of changed modules."""
+
+import atexit
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Dict, List, Optional
+
+import deletion_service
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class ThinLTOCache:
+    """The ThinLTO cache of lld, shared by the LTO builds of stage2.
+
+    LLVM's CMake points lld at the lto.cache dir in the build dir, which is
+    replaced by a link to root. lld prunes the cache down to max_size bytes
+    and drops entries unused for prune_after_hours.
+
+    Entries created by this build count as misses. Entries that existed
+    before count as hits if they were accessed or modified since it started.
+    With relatime or noatime mounts, reads don't always update the access
+    time, so hits are a lower bound. The report also counts the reused
+    entries, the ones that existed before and were kept. They include hits
+    that weren't recorded, as well as entries this build didn't need.
+    """
+
+    def __init__(self, root: Path, max_size: int, prune_after_hours: int = 7 * 24) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.prune_after_hours = prune_after_hours
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._start_time = time.time()
+        self._entries_before = self._entries()
+
+    def _entries(self) -> Dict[str, os.stat_result]:
+        entries: Dict[str, os.stat_result] = {}
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith('llvmcache-'):
+                    try:
+                        entries[entry.name] = entry.stat()
+                    except FileNotFoundError:
+                        # Pruned by a concurrent link.
+                        pass
+        return entries
+
+    @property
+    def ldflags(self) -> List[str]:
+        """Linker flags with the pruning policy of the cache."""
+        policy = f'cache_size_bytes={self.max_size}:prune_after={self.prune_after_hours}h'
+        return [f'-Wl,--thinlto-cache-policy={policy}']
+
+    def link(self, build_dir: Path) -> None:
+        """Points the lto.cache dir of build_dir at the cache."""
+        cache_link = build_dir / 'lto.cache'
+        if cache_link.is_symlink():
+            if Path(os.readlink(cache_link)) == self.root:
+                return
+            cache_link.unlink()
+        elif cache_link.exists():
+            deletion_service.delete(cache_link)
+        build_dir.mkdir(parents=True, exist_ok=True)
+        cache_link.symlink_to(self.root, target_is_directory=True)
+
+    def report(self) -> str:
+        """Returns the hits, misses, evictions and size of the cache in this build."""
+        entries = self._entries()
+        reused = entries.keys() & self._entries_before.keys()
+        hits = sum(1 for name in reused
+                   if max(entries[name].st_atime, entries[name].st_mtime) >= self._start_time)
+        misses = len(entries.keys() - self._entries_before.keys())
+        evicted = len(self._entries_before.keys() - entries.keys())
+        hit_rate = hits / (hits + misses) if hits + misses else 0.0
+        size = sum(stat.st_size for stat in entries.values())
+        return '\n'.join([
+            f'ThinLTO cache {self.root}:',
+            f'  {hits} hits, {misses} misses ({hit_rate:.1%} hit rate, hits are a lower bound)',
+            f'  {len(reused)} reused, {evicted} evicted, {len(entries)} entries',
+            f'  {size / 1024**3:.2f} of {self.max_size / 1024**3:.2f} GiB',
+        ])
+
+    def report_to_file(self, outfile: Path) -> None:
+        """Logs the report and writes it to outfile."""
+        report = self.report()
+        logger().info('%s', report)
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        outfile.write_text(report + '\n')
+
+
+_cache: Optional[ThinLTOCache] = None
+
+
+def start(root: Path, max_size: int, report_file: Path) -> ThinLTOCache:
+    """Shares the ThinLTO cache at root, and writes its report to report_file at exit."""
+    global _cache  # pylint: disable=global-statement
+    _cache = ThinLTOCache(root, max_size)
+    atexit.register(_cache.report_to_file, report_file)
+    return _cache
+
+
+def get() -> Optional[ThinLTOCache]:
+    """Returns the ThinLTO cache, or None if LTO builds use their own."""
+    return _cache
@@ -18,18 +18,43 @@ from datetime import timedelta
 
 import atexit
 import os
+import threading
 
 class Timer:
     times = {}
-    def __init__(self, descr):
+    # (start, end, parent) of each description, for build_report. parent is
+    # the description of the step this is a phase of, if any.
+    spans = {}
+    # The steps each step waited for, for build_report. Steps wait for the
+    # steps before them in the same thread, and scheduler tasks for the last
+    # steps of the tasks they depend on. See frontier().
+    deps = {}
+    _context = threading.local()
+    def __init__(self, descr, parent=None):
         self.descr = descr
+        self.parent = parent
 
     def __enter__(self):
         self.start = time()
+        self.after = type(self).frontier()
 
     def __exit__(self, t, value, traceback):
         end = time()
         type(self).times[self.descr] = end - self.start
+        type(self).spans[self.descr] = (self.start, end, self.parent)
+        if self.parent is None:
+            type(self).deps[self.descr] = self.after
+            type(self).set_frontier([self.descr])
+
+    @classmethod
+    def frontier(cls):
+        """Return the last steps that the work in this thread waited for."""
+        return list(getattr(cls._context, 'frontier', []))
+
+    @classmethod
+    def set_frontier(cls, steps):
+        """Make the next step in this thread wait for steps, e.g. when a task starts."""
+        cls._context.frontier = list(dict.fromkeys(steps))
 
     @classmethod
     def report(cls):
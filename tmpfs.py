@@ -0,0 +1,118 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Puts the build trees of selected builders on a tmpfs."""
+
+import errno
+import logging
+from pathlib import Path
+import shutil
+import subprocess
+import threading
+from typing import Dict, Iterable, Optional
+
+import deletion_service
+import paths
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class TmpfsBuildDirs:
+    """Moves the build dirs of selected builders from OUT_DIR to a tmpfs.
+
+    A build dir is placed on the tmpfs only if the tmpfs has min_free bytes
+    free when the dir is first used, and stays in OUT_DIR otherwise. A build
+    that fails because the tmpfs ran out of space falls back to OUT_DIR too.
+    Other failures are left alone, so they aren't hidden by a rebuild. Builders
+    install outside of their build dir, so build dirs are removed from the
+    tmpfs once their config is installed.
+    """
+
+    def __init__(self, root: Path, builders: Iterable[str], min_free: int) -> None:
+        self.root = root
+        self.builders = set(builders)
+        self.min_free = min_free
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._placed: Dict[Path, Path] = {}
+
+    def _is_full(self) -> bool:
+        return shutil.disk_usage(self.root).free < self.min_free
+
+    def _ran_out_of_space(self, error: Exception) -> bool:
+        if isinstance(error, OSError):
+            return error.errno == errno.ENOSPC
+        if isinstance(error, subprocess.CalledProcessError):
+            # The tools don't report why they failed. Failed outputs are
+            # removed, so the tmpfs doesn't have to be completely full.
+            usage = shutil.disk_usage(self.root)
+            return usage.free < usage.total // 100
+        return False
+
+    def place(self, name: str, output_dir: Path) -> Path:
+        """Returns where the build dir output_dir of builder name goes."""
+        if name not in self.builders or not output_dir.is_relative_to(paths.OUT_DIR):
+            return output_dir
+        with self._lock:
+            if output_dir not in self._placed:
+                if self._is_full():
+                    logger().warning('tmpfs %s is full, building %s in %s',
+                                     self.root, name, output_dir)
+                    self._placed[output_dir] = output_dir
+                else:
+                    self._placed[output_dir] = self.root / output_dir.relative_to(paths.OUT_DIR)
+            return self._placed[output_dir]
+
+    def is_placed(self, build_dir: Path) -> bool:
+        """Tests whether build_dir is on the tmpfs."""
+        return build_dir.is_relative_to(self.root)
+
+    def fall_back(self, output_dir: Path, build_dir: Path, error: Exception) -> bool:
+        """Moves output_dir back to OUT_DIR after a build in build_dir failed with error.
+
+        Returns False if the failure wasn't caused by a full tmpfs.
+        """
+        with self._lock:
+            if not self.is_placed(build_dir) or not self._ran_out_of_space(error):
+                return False
+            logger().warning('tmpfs %s is full, moving %s back to %s',
+                             self.root, build_dir, output_dir)
+            self._placed[output_dir] = output_dir
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return True
+
+    def release(self, build_dir: Path) -> None:
+        """Removes a build dir from the tmpfs, if it is there."""
+        if self.is_placed(build_dir):
+            deletion_service.delete(build_dir)
+
+
+_dirs: Optional[TmpfsBuildDirs] = None
+
+
+def start(root: Path, builders: Iterable[str], min_free: int) -> TmpfsBuildDirs:
+    """Places the build dirs of builders on the tmpfs at root."""
+    global _dirs  # pylint: disable=global-statement
+    _dirs = TmpfsBuildDirs(root, builders, min_free)
+    logger().info('Building %s on tmpfs %s', ', '.join(sorted(_dirs.builders)), root)
+    return _dirs
+
+
+def get() -> Optional[TmpfsBuildDirs]:
+    """Returns the tmpfs build dirs, or None if they are disabled."""
+    return _dirs
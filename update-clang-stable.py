@@ -71,15 +71,14 @@ class ClangStableBuilder:
             f'All contents in clang-stable are copies of clang-{self.version}.')
 
     def copy_file(self, src_file: Path, dst_dir: Path):
-        shutil.copy(src_file, dst_dir, follow_symlinks=False)
+        utils.copy_file(src_file, dst_dir, follow_symlinks=False)
 
     def copy_files(self, src_files: List[Path], dst_dir: Path):
         for src_file in src_files:
             self.copy_file(src_file, dst_dir)
 
     def copy_dir(self, src_dir: Path, dst_parent_dir: Path):
-        shutil.copytree(src_dir, dst_parent_dir / src_dir.name,
-                        symlinks=True, ignore_dangling_symlinks=True)
+        utils.copy_tree(src_dir, dst_parent_dir / src_dir.name, symlinks=True)
 
     def test(self):
         utils.check_call([self.stable_dir / 'bin' / 'clang-format', '-h'],
@@ -15,14 +15,22 @@
 #
 # pylint: disable=not-callable
 
+from concurrent import futures
 import contextlib
 import datetime
+import errno
+import fcntl
+import hashlib
+import json
 import logging
 import os
 from pathlib import Path
 import shlex
+import shutil
 import subprocess
-from typing import Dict, List
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
 
 import constants
 import paths
@@ -60,6 +68,134 @@ def check_output(cmd, *args, **kwargs):
     return subprocess_run(cmd, *args, **kwargs, check=True, stdout=subprocess.PIPE).stdout
 
 
+def fingerprint(obj: Any) -> str:
+    """Returns a stable hash of a json-like object. Other values are hashed as strings."""
+    data = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# From linux/fs.h.
+_FICLONE = 0x40049409
+# Errors of FICLONE and copy_file_range on filesystems, or pairs of
+# filesystems, that don't support them.
+_UNSUPPORTED_COPY_ERRNOS = (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                            errno.EOPNOTSUPP, errno.EXDEV)
+
+
+def _clone_or_copy_file(src: Path, dst: Path, hardlink: bool) -> None:
+    """Copies the contents of src to the new file dst.
+
+    Tries a reflink clone first, then os.copy_file_range, then a hard link if
+    hardlink is set, then a plain copy.
+    """
+    with open(src, 'rb') as src_file:
+        with open(dst, 'xb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                    raise
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while os.copy_file_range(src_file.fileno(), dst_file.fileno(), 1 << 30):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                        raise
+                    dst_file.seek(0)
+                    dst_file.truncate()
+            if not hardlink:
+                src_file.seek(0)
+                shutil.copyfileobj(src_file, dst_file)
+                return
+    try:
+        dst.unlink()
+        os.link(src, dst)
+    except OSError:
+        _clone_or_copy_file(src, dst, hardlink=False)
+
+
+def copy_file(src: Path, dst: Path, follow_symlinks: bool = True,
+              hardlink: bool = False) -> int:
+    """Like shutil.copy2, but clones the file if the filesystem supports it.
+
+    The copy is written under a temporary name and renamed over dst, so an
+    existing dst is replaced rather than written through, and concurrent
+    copies to dst never leave a partial file. Hard links are only used if
+    hardlink is set, which is safe only if neither src nor dst is modified
+    in place later. Returns the number of bytes copied.
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmp.unlink(missing_ok=True)
+    try:
+        if not follow_symlinks and src.is_symlink():
+            os.symlink(os.readlink(src), tmp)
+            os.replace(tmp, dst)
+            return 0
+        _clone_or_copy_file(src, tmp, hardlink)
+        if not tmp.samefile(src):
+            shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Left behind on failure, or if dst already was a hard link to src.
+        tmp.unlink(missing_ok=True)
+    return dst.stat().st_size
+
+
+_dir_locks: Dict[Path, threading.Lock] = {}
+_dir_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def dir_lock(path: Path) -> Iterator[None]:
+    """Serializes the writers of the directory path in this process, e.g. concurrent installs."""
+    path = Path(os.path.abspath(path))
+    with _dir_locks_lock:
+        lock = _dir_locks.setdefault(path, threading.Lock())
+    with lock:
+        yield
+
+
+def copy_tree(src: Path, dst: Path, symlinks: bool = False, dirs_exist_ok: bool = False,
+              hardlink: bool = False, jobs: Optional[int] = None) -> int:
+    """Like shutil.copytree, but copies files with copy_file, jobs at a time.
+
+    Returns the number of bytes copied.
+    """
+    src, dst = Path(src), Path(dst)
+    start = time.time()
+    dst.mkdir(parents=True, exist_ok=dirs_exist_ok)
+    dirs: List[Path] = [src]
+    with futures.ThreadPoolExecutor(max_workers=jobs or min(32, os.cpu_count() or 1),
+                                    thread_name_prefix='copy') as executor:
+        copies: List[futures.Future] = []
+        for root, dirnames, filenames in os.walk(src, followlinks=not symlinks):
+            root_path = Path(root)
+            dst_root = dst / root_path.relative_to(src)
+            for name in list(dirnames):
+                if symlinks and (root_path / name).is_symlink():
+                    dirnames.remove(name)
+                    filenames.append(name)
+                else:
+                    (dst_root / name).mkdir(exist_ok=True)
+                    dirs.append(root_path / name)
+            for name in filenames:
+                copies.append(executor.submit(copy_file, root_path / name, dst_root / name,
+                                              follow_symlinks=not symlinks,
+                                              hardlink=hardlink))
+        copied = sum(copy.result() for copy in copies)
+    for src_dir in dirs:
+        shutil.copystat(src_dir, dst / src_dir.relative_to(src))
+    logger().info('Copied %d files, %.1f MiB, from %s to %s in %.1fs', len(copies),
+                  copied / (1 << 20), src, dst, time.time() - start)
+    return copied
+
+
 def is_available_mac_ver(ver: str) -> bool:
     """Returns whether a version string is equal to or under MAC_MIN_VERSION."""
     _parse_version = lambda ver: list(int(v) for v in ver.split('.'))